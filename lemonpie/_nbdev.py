@@ -19,11 +19,22 @@ index = {"get_device": "00_basics.ipynb",
          "SYNTHEA_DATAGEN_DATES": "00_basics.ipynb",
          "CONDITIONS": "00_basics.ipynb",
          "LOG_NUMERICALIZE_EXCEP": "00_basics.ipynb",
+         "STORAGE_FORMAT": "00_basics.ipynb",
+         "EXECUTOR": "00_basics.ipynb",
+         "PTLIST_WORKERS": "00_basics.ipynb",
+         "table_path": "01_preprocessing_clean.ipynb",
+         "save_table": "01_preprocessing_clean.ipynb",
+         "find_table": "01_preprocessing_clean.ipynb",
+         "load_table": "01_preprocessing_clean.ipynb",
          "read_raw_ehrdata": "01_preprocessing_clean.ipynb",
+         "hash_split_ids": "01_preprocessing_clean.ipynb",
          "split_patients": "01_preprocessing_clean.ipynb",
          "split_ehr_dataset": "01_preprocessing_clean.ipynb",
+         "append_parquet": "01_preprocessing_clean.ipynb",
+         "split_ehr_dataset_chunked": "01_preprocessing_clean.ipynb",
          "cleanup_pts": "01_preprocessing_clean.ipynb",
          "cleanup_obs": "01_preprocessing_clean.ipynb",
+         "expand_start_stop": "01_preprocessing_clean.ipynb",
          "cleanup_algs": "01_preprocessing_clean.ipynb",
          "cleanup_crpls": "01_preprocessing_clean.ipynb",
          "cleanup_meds": "01_preprocessing_clean.ipynb",
@@ -33,26 +44,67 @@ index = {"get_device": "00_basics.ipynb",
          "cleanup_immns": "01_preprocessing_clean.ipynb",
          "extract_ys": "01_preprocessing_clean.ipynb",
          "insert_age": "01_preprocessing_clean.ipynb",
+         "read_cleanup": "01_preprocessing_clean.ipynb",
+         "persist_table": "01_preprocessing_clean.ipynb",
+         "CLEANUP_FNS": "01_preprocessing_clean.ipynb",
+         "TaskExecutor": "01_preprocessing_clean.ipynb",
+         "RayExecutor": "01_preprocessing_clean.ipynb",
+         "PoolExecutor": "01_preprocessing_clean.ipynb",
+         "SerialExecutor": "01_preprocessing_clean.ipynb",
+         "get_executor": "01_preprocessing_clean.ipynb",
+         "run_tasks": "01_preprocessing_clean.ipynb",
+         "EXECUTORS": "01_preprocessing_clean.ipynb",
+         "object_store_usage": "01_preprocessing_clean.ipynb",
+         "wait_stages": "01_preprocessing_clean.ipynb",
+         "wait_stage": "01_preprocessing_clean.ipynb",
+         "cleanup_dataset": "01_preprocessing_clean.ipynb",
+         "preprocess_dataset": "01_preprocessing_clean.ipynb",
          "clean_preprocess_dataset": "01_preprocessing_clean.ipynb",
          "persist_cleaned": "01_preprocessing_clean.ipynb",
+         "file_fingerprint": "01_preprocessing_clean.ipynb",
+         "cleaning_fingerprints": "01_preprocessing_clean.ipynb",
+         "changed_tables": "01_preprocessing_clean.ipynb",
          "clean_raw_ehrdata": "01_preprocessing_clean.ipynb",
          "load_cleaned_ehrdata": "01_preprocessing_clean.ipynb",
+         "convert_csv_store": "01_preprocessing_clean.ipynb",
          "load_ehr_vocabcodes": "01_preprocessing_clean.ipynb",
          "test_extract_ys": "01_preprocessing_clean.ipynb",
          "get_label_counts": "01_preprocessing_clean.ipynb",
          "test_cleaned_ehrdata": "01_preprocessing_clean.ipynb",
          "multiple_of_8": "02_preprocessing_vocab.ipynb",
          "EhrVocab": "02_preprocessing_vocab.ipynb",
+         "nested_uniques": "02_preprocessing_vocab.ipynb",
+         "linspace_rows": "02_preprocessing_vocab.ipynb",
          "ObsVocab": "02_preprocessing_vocab.ipynb",
          "EhrVocabList": "02_preprocessing_vocab.ipynb",
          "get_all_emb_dims": "02_preprocessing_vocab.ipynb",
          "collate_codes_offsts": "03_preprocessing_transform.ipynb",
+         "collate_all_codes_offsts": "03_preprocessing_transform.ipynb",
+         "slice_rows": "03_preprocessing_transform.ipynb",
+         "PatientIndex": "03_preprocessing_transform.ipynb",
+         "patient_hashes": "03_preprocessing_transform.ipynb",
          "get_codenums_offsts": "03_preprocessing_transform.ipynb",
+         "get_all_codenums_arrays": "03_preprocessing_transform.ipynb",
+         "get_pt_codenums_offsts": "03_preprocessing_transform.ipynb",
+         "get_all_codenums_offsts": "03_preprocessing_transform.ipynb",
          "get_demographics": "03_preprocessing_transform.ipynb",
+         "get_age_span": "03_preprocessing_transform.ipynb",
          "Patient": "03_preprocessing_transform.ipynb",
+         "REC_NAMES": "03_preprocessing_transform.ipynb",
+         "PatientBatch": "03_preprocessing_transform.ipynb",
+         "collate_patients": "03_preprocessing_transform.ipynb",
          "get_pckl_dir": "03_preprocessing_transform.ipynb",
+         "ColumnarPatients": "03_preprocessing_transform.ipynb",
+         "SharedRecords": "03_preprocessing_transform.ipynb",
+         "load_ptlist_items": "03_preprocessing_transform.ipynb",
+         "ptlist_manifest": "03_preprocessing_transform.ipynb",
+         "save_ptlist_manifest": "03_preprocessing_transform.ipynb",
+         "SegmentedPatients": "03_preprocessing_transform.ipynb",
+         "balanced_chunks": "03_preprocessing_transform.ipynb",
          "PatientList": "03_preprocessing_transform.ipynb",
          "cpu_cnt": "03_preprocessing_transform.ipynb",
+         "delete_ptlist_files": "03_preprocessing_transform.ipynb",
+         "compact_ptlist": "03_preprocessing_transform.ipynb",
          "create_all_ptlists": "03_preprocessing_transform.ipynb",
          "preprocess_ehr_dataset": "03_preprocessing_transform.ipynb",
          "EHRDataSplits": "04_data.ipynb",
@@ -73,11 +125,13 @@ index = {"get_device": "00_basics.ipynb",
          "plot_rocs": "05_metrics.ipynb",
          "plot_train_valid_rocs": "05_metrics.ipynb",
          "auroc_score": "05_metrics.ipynb",
+         "bootstrap_aurocs": "05_metrics.ipynb",
          "auroc_ci": "05_metrics.ipynb",
          "save_to_checkpoint": "06_learn.ipynb",
          "load_from_checkpoint": "06_learn.ipynb",
          "get_loss_fn": "06_learn.ipynb",
          "RunHistory": "06_learn.ipynb",
+         "PredictionAccumulator": "06_learn.ipynb",
          "train": "06_learn.ipynb",
          "evaluate": "06_learn.ipynb",
          "fit": "06_learn.ipynb",
@@ -89,6 +143,8 @@ index = {"get_device": "00_basics.ipynb",
          "plot_fit_results": "06_learn.ipynb",
          "summarize_prediction": "06_learn.ipynb",
          "count_parameters": "06_learn.ipynb",
+         "BinnedAUROC": "07_models.ipynb",
+         "get_auroc_metric": "07_models.ipynb",
          "get_loss_fns": "07_models.ipynb",
          "dropout_mask": "07_models.ipynb",
          "InputDropout": "07_models.ipynb",
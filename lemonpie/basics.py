@@ -2,7 +2,8 @@
 
 __all__ = ['get_device', 'settings_template', 'read_settings', 'DEVICE', 'settings', 'DATA_STORE', 'LOG_STORE',
            'MODEL_STORE', 'EXPERIMENT_STORE', 'PATH_1K', 'PATH_10K', 'PATH_20K', 'PATH_100K', 'FILENAMES',
-           'SYNTHEA_DATAGEN_DATES', 'CONDITIONS', 'LOG_NUMERICALIZE_EXCEP']
+           'SYNTHEA_DATAGEN_DATES', 'CONDITIONS', 'LOG_NUMERICALIZE_EXCEP', 'STORAGE_FORMAT', 'EXECUTOR',
+           'PTLIST_WORKERS']
 
 # Cell
 from fastai.imports import *
@@ -54,7 +55,10 @@ def settings_template():
             'rheumatoid_arthritis': '69896004',
             'epilepsy': '84757009'
         },
-        'LOG_NUMERICALIZE_EXCEP': True
+        'LOG_NUMERICALIZE_EXCEP': True,
+        'STORAGE_FORMAT': 'csv',
+        'EXECUTOR': 'ray',
+        'PTLIST_WORKERS': None
     }
 
     return template
@@ -97,4 +101,10 @@ SYNTHEA_DATAGEN_DATES = settings.SYNTHEA_DATAGEN_DATES
 
 CONDITIONS = settings.CONDITIONS
 
-LOG_NUMERICALIZE_EXCEP = settings.LOG_NUMERICALIZE_EXCEP
\ No newline at end of file
+LOG_NUMERICALIZE_EXCEP = settings.LOG_NUMERICALIZE_EXCEP
+
+STORAGE_FORMAT = settings.STORAGE_FORMAT or 'csv' # 'csv' or 'parquet' - for `raw_split` & `cleaned` data
+
+EXECUTOR = settings.EXECUTOR or 'ray' # 'ray', 'process' or 'serial' - for the cleaning pipeline
+
+PTLIST_WORKERS = settings.PTLIST_WORKERS or None # number of processes transforming patients, all cores if not set
\ No newline at end of file
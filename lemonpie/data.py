@@ -7,7 +7,7 @@ __all__ = ['EHRDataSplits', 'LabelEHRData', 'EHRDataset', 'ModalityTypeBatchSamp
 from .basics import *
 from .preprocessing.transform import *
 from fastai.imports import *
-import copy, glob
+import glob
 
 # Cell
 class EHRDataSplits:
@@ -112,7 +112,11 @@ class LabelEHRData():
         self.test  = self.x_test,  self.y_test
 
     def _get_y(self, ds, labels):
-        '''Extract y from each patient object in ds and stack them - ds is dataset containing patient objects'''
+        '''Extract y from each patient object in ds and stack them - ds is dataset containing patient objects.
+        Columnar patient lists are read straight from their labels array'''
+        items = getattr(ds, 'items', ds)
+        if hasattr(items, 'label_values'):
+            return torch.FloatTensor(np.asarray(items.label_values(labels), dtype='float'))
         y = []
         for pt in ds:
             y.append( torch.FloatTensor(np.array([pt.conditions[label] for label in labels], dtype='float')) )
@@ -139,12 +143,16 @@ class EHRDataset(torch.utils.data.Dataset):
         self.lazy = lazy_load_gpu
 
         if self.lazy == False:
-            self.x = [pt.to_gpu() for pt in self.x]
+            self.x = [pt.to(DEVICE) for pt in self.x]
             self.y = self.y.to(DEVICE)
             self.m = self.m.to(DEVICE)
 
     def _get_y(self, ptlist, labels):
-        """Extract y from each patient object in ptlist and stack them."""
+        """Extract y from each patient object in ptlist and stack them - columnar patient lists
+        are read straight from their labels array, without creating `Patient` objects."""
+        items = getattr(ptlist, "items", ptlist)
+        if hasattr(items, "label_values"):
+            return torch.FloatTensor(np.asarray(items.label_values(labels), dtype="float"))
         y = []
         for pt in ptlist:
             y.append(
@@ -161,12 +169,9 @@ class EHRDataset(torch.utils.data.Dataset):
         return self.x[i], self.y[i], self.m
 
     def __getitem__(self, i):
-        """If lazy loading, return deep copy of patient object `i`
-        else entire dataset already on GPU - just return `i`."""
-        if self.lazy:
-            return copy.deepcopy(self.x[i]), self.y[i], self.m  # make m[i] if tensor
-        else:
-            return self.x[i], self.y[i], self.m
+        """Return patient object `i` without copying it - pinning (`Patient.pin_memory`) and
+        GPU transfer (`Patient.to`) return new objects, so the stored patient is never modified."""
+        return self.x[i], self.y[i], self.m  # make m[i] if tensor
 
 
 # Cell
@@ -262,9 +267,10 @@ class MultimodalDataset(torch.utils.data.Dataset):
 
 # Cell
 def multimodal_collate(batch):
-    """Custom collate fn for EHR plus 3 other modalities."""
+    """Custom collate fn for EHR plus 3 other modalities - patients are collated into a `PatientBatch`."""
     ehr, other = zip(*batch)
     pts, ys, ms = zip(*ehr)
+    pts = collate_patients(pts)
     ys = torch.stack(ys)
 
     if ms[0] in [1, 10, 20]:
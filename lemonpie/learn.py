@@ -1,8 +1,8 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/06_learn.ipynb (unless otherwise specified).
 
-__all__ = ['save_to_checkpoint', 'load_from_checkpoint', 'get_loss_fn', 'RunHistory', 'train', 'evaluate', 'fit',
-           'predict', 'plot_loss', 'plot_losses', 'plot_aurocs', 'plot_train_valid_aurocs', 'plot_fit_results',
-           'summarize_prediction', 'count_parameters']
+__all__ = ['save_to_checkpoint', 'load_from_checkpoint', 'get_loss_fn', 'RunHistory', 'PredictionAccumulator', 'train',
+           'evaluate', 'fit', 'predict', 'plot_loss', 'plot_losses', 'plot_aurocs', 'plot_train_valid_aurocs',
+           'plot_fit_results', 'summarize_prediction', 'count_parameters']
 
 # Cell
 from .basics import *
@@ -49,23 +49,44 @@ class RunHistory:
         self.y_train = self.yhat_train = self.y_valid = self.yhat_valid = self.y_test = self.yhat_test = []
         self.prediction_summary = pd.DataFrame()
 
+# Cell
+class PredictionAccumulator:
+    '''Accumulate an epoch's predictions, targets & loss in buffers preallocated for `len(dl.dataset)` rows on the model's device,
+    without a copy or host sync per step - results are copied to CPU once per epoch'''
+    def __init__(self, dl):
+        self.n, self.pos = len(dl.dataset), 0
+        self.yhat = self.y = self.loss = None
+
+    def add(self, y_hat, yb, loss):
+        '''Add a batch - buffers are allocated on the first batch, once the number of labels and device are known'''
+        if self.yhat is None:
+            self.yhat = torch.empty(self.n, y_hat.shape[1], device=y_hat.device)
+            self.y    = torch.empty(self.n, yb.shape[1], device=yb.device)
+            self.loss = torch.zeros((), device=y_hat.device)
+        bs = len(yb)
+        self.yhat[self.pos:self.pos+bs] = y_hat.detach()
+        self.y[self.pos:self.pos+bs]    = yb.detach()
+        self.loss += loss.detach()
+        self.pos  += bs
+
+    def results(self):
+        '''Return total loss, yhat & y (on CPU)'''
+        if self.yhat is None: return 0., Tensor([]), Tensor([])
+        return self.loss.item(), self.yhat[:self.pos].cpu(), self.y[:self.pos].cpu()
+
 # Cell
 def train(model, train_dl, train_loss_fn, optimizer, lazy=True, use_amp = True, scaler=None):
     '''Train model using train dataset'''
-    yhat_train = y_train = Tensor([])
-    train_loss = 0.
+    acc = PredictionAccumulator(train_dl)
     model.train()
 
     for xb, yb in train_dl:
-        if lazy: xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(DEVICE, non_blocking=True)
+        if lazy: xb, yb = xb.to(DEVICE, non_block=True), yb.to(DEVICE, non_blocking=True)
         with torch.cuda.amp.autocast(enabled=use_amp):
             y_hat  = model(xb)
             loss   = train_loss_fn(y_hat, yb)
 
-        train_loss += loss.item()
-        yhat_train = torch.cat((yhat_train, y_hat.cpu().detach() ))
-#         yhat_train = torch.cat((yhat_train, torch.sigmoid( y_hat.cpu().detach() ) )) #just for AMP testing for now
-        y_train    = torch.cat((y_train, yb.cpu().detach()))
+        acc.add(y_hat, yb, loss)
 
         if use_amp:
             scaler.scale(loss).backward()
@@ -77,29 +98,25 @@ def train(model, train_dl, train_loss_fn, optimizer, lazy=True, use_amp = True,
 
         model.zero_grad(set_to_none=True)
 
+    train_loss, yhat_train, y_train = acc.results()
     return train_loss, yhat_train, y_train, model
 
 # Cell
 def evaluate(model, eval_dl, eval_loss_fn, lazy=True, use_amp = True):
     '''Evaluate model - used for validation (while training) and prediction'''
-    yhat_eval = y_eval = Tensor([])
-    eval_loss = 0.
+    acc = PredictionAccumulator(eval_dl)
     model.eval()
 
     with torch.no_grad():
         for xb, yb in eval_dl:
-            if lazy: xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(DEVICE, non_blocking=True)
+            if lazy: xb, yb = xb.to(DEVICE, non_block=True), yb.to(DEVICE, non_blocking=True)
             with torch.cuda.amp.autocast(enabled=use_amp):
                 y_hat  = model(xb)
                 loss   = eval_loss_fn(y_hat, yb)
 
-#             eval_loss += (eval_loss_fn(y_hat, yb)).item()
-            eval_loss += loss.item()
-#             yhat_eval = torch.cat((yhat_eval, torch.sigmoid( y_hat.cpu().detach() ) )) # for amp testing
-            yhat_eval = torch.cat((yhat_eval, y_hat.cpu().detach() ))
-            y_eval    = torch.cat((y_eval, yb.cpu().detach()))
+            acc.add(y_hat, yb, loss)
 
-    return eval_loss, yhat_eval, y_eval
+    return acc.results()
 
 # Cell
 def fit(epochs, history, model, train_loss_fn, valid_loss_fn, optimizer, accuracy_fn,
@@ -226,8 +243,9 @@ def summarize_prediction(history, labels, plot=True):
     print('\nPrediction Summary ...')
     col_names = ['auroc_score', 'optimal_threshold', 'auroc_95_ci']
     rows = []
+    cis = auroc_ci(h.y_test, h.yhat_test)  # all labels in one call
     for i, label in enumerate(labels):
-        row = [test_rocs.ROCs[label].auroc, test_rocs.ROCs[label].optimal_thresh(), auroc_ci(h.y_test[:,i], h.yhat_test[:,i])]
+        row = [test_rocs.ROCs[label].auroc, test_rocs.ROCs[label].optimal_thresh(), cis[i]]
         rows.append(row)
     history.prediction_summary = pd.DataFrame(rows, index=labels, columns=col_names)
     print(history.prediction_summary)
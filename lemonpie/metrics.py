@@ -1,12 +1,13 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/05_metrics.ipynb (unless otherwise specified).
 
 __all__ = ['accuracy', 'null_accuracy', 'ROC', 'MultiLabelROC', 'plot_rocs', 'plot_train_valid_rocs', 'auroc_score',
-           'auroc_ci']
+           'bootstrap_aurocs', 'auroc_ci']
 
 # Cell
 from .basics import *
 from fastai.imports import *
 from sklearn import metrics as skl_metrics, preprocessing as skl_preproc
+import torch.multiprocessing as multiprocessing
 
 # Cell
 def accuracy(y:'y_true', yhat:'yhat_prob', threshold:float=0.5) -> float:
@@ -82,23 +83,46 @@ def auroc_score(y, yhat, average=None):
     return skl_metrics.roc_auc_score(y, yhat, average=average)
 
 # Cell
-def auroc_ci(y, yhat):
-    '''Returns 95% confidence interval for auroc'''
-    n_bootstraps = 1000
-    rng_seed = 42  # control reproducibility
-    bootstrapped_scores = []
-
+def _bootstrap_chunk(indices, y, yhat):
+    '''AUROC of each resample (row of `indices`) for each label from rank statistics (Mann-Whitney U), NaN if single class'''
+    n_rows, n = indices.shape
+    res = np.empty((y.shape[1], n_rows))
+    for l in range(y.shape[1]):
+        groups, grp = np.unique(yhat[:, l], return_inverse=True)  # tied scores share a group - sorted once per label
+        flat = (grp[indices] + np.arange(n_rows)[:, None] * len(groups)).ravel()
+        counts = np.bincount(flat, minlength=n_rows*len(groups)).reshape(n_rows, -1)
+        pos = np.bincount(flat, weights=y[indices, l].ravel(), minlength=n_rows*len(groups)).reshape(n_rows, -1)
+        mid_ranks = np.cumsum(counts, axis=1) - (counts - 1) / 2  # average rank of tied scores
+        n_pos = pos.sum(axis=1)
+        n_neg = n - n_pos
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aurocs = ((pos * mid_ranks).sum(axis=1) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+        res[l] = np.where((n_pos > 0) & (n_neg > 0), aurocs, np.nan)
+    return res
+
+def bootstrap_aurocs(y, yhat, n_bootstraps=1000, rng_seed=42, chunk_size=100, n_workers=None):
+    '''AUROCs of bootstrap resamples for all labels (columns) - resamples with a single class are rejected.
+    Indices are drawn in chunks of a `(n_bootstraps, n)` matrix, the same resamples as sequential `rng.randint` calls,
+    and chunks can be spread over `n_workers` processes'''
+    y, yhat = np.asarray(y, dtype=float), np.asarray(yhat, dtype=float)
+    if y.ndim == 1: y, yhat = y[:, None], yhat[:, None]
     rng = np.random.RandomState(rng_seed)
-    for i in range(n_bootstraps):
-        # bootstrap by sampling with replacement on the prediction indices
-        indices = rng.randint(0, len(y), len(y))
-        if len(np.unique(y[indices])) < 2: continue   # reject this sample
-        score = skl_metrics.roc_auc_score(y[indices], yhat[indices])
-        bootstrapped_scores.append(score)
-
-    sorted_scores = np.array(bootstrapped_scores)
-    sorted_scores.sort()
+    chunks = [rng.randint(0, len(y), (min(chunk_size, n_bootstraps-i), len(y))) for i in range(0, n_bootstraps, chunk_size)]
+    if n_workers:
+        with multiprocessing.Pool(n_workers) as pool:
+            scores = pool.map(partial(_bootstrap_chunk, y=y, yhat=yhat), chunks)
+    else:
+        scores = [_bootstrap_chunk(indices, y, yhat) for indices in chunks]
+    scores = np.concatenate(scores, axis=1)
+    return [label_scores[~np.isnan(label_scores)] for label_scores in scores]
 
-    confidence_lower = sorted_scores[int(0.025 * len(sorted_scores))]
-    confidence_upper = sorted_scores[int(0.975 * len(sorted_scores))]
-    return round(confidence_lower,3), round(confidence_upper,3)
\ No newline at end of file
+# Cell
+def auroc_ci(y, yhat, n_bootstraps=1000, rng_seed=42, n_workers=None):
+    '''Returns 95% confidence interval for auroc - a list of them if `y` & `yhat` have multiple labels (columns)'''
+    cis = []
+    for bootstrapped_scores in bootstrap_aurocs(y, yhat, n_bootstraps, rng_seed, n_workers=n_workers):
+        sorted_scores = np.sort(bootstrapped_scores)
+        confidence_lower = sorted_scores[int(0.025 * len(sorted_scores))]
+        confidence_upper = sorted_scores[int(0.975 * len(sorted_scores))]
+        cis.append((round(confidence_lower,3), round(confidence_upper,3)))
+    return cis if np.ndim(y) > 1 else cis[0]
\ No newline at end of file
@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/07_models.ipynb (unless otherwise specified).
 
-__all__ = ['get_loss_fns', 'dropout_mask', 'InputDropout', 'linear_layer', 'create_linear_layers', 'init_lstm',
-           'EHR_LSTM', 'init_cnn', 'conv_layer', 'EHR_CNN']
+__all__ = ['BinnedAUROC', 'get_auroc_metric', 'get_loss_fns', 'dropout_mask', 'InputDropout', 'linear_layer',
+           'create_linear_layers', 'init_lstm', 'EHR_LSTM', 'init_cnn', 'conv_layer', 'EHR_CNN']
 
 # Cell
 from .basics import *
@@ -16,7 +16,62 @@ from fastai.imports import *
 
 # Cell
 import pytorch_lightning as pl
-from torchmetrics import MetricCollection, AUROC, Accuracy
+from torchmetrics import MetricCollection, AUROC, Accuracy, Metric
+
+
+# Cell
+class BinnedAUROC(Metric):
+    """Streaming AUROC from fixed-size histograms of sigmoid scores per label - memory is constant in dataset size
+    and `compute` is O(`num_bins`). Scores in the same bin count as ties, so the difference from the exact AUROC
+    is at most `max_error()` (half the fraction of positive-negative pairs sharing a bin) - below 1e-3 with the
+    default 1000 bins unless scores are heavily concentrated."""
+
+    full_state_update = False
+
+    def __init__(self, num_labels, num_bins=1000, average="micro", **kwargs):
+        super().__init__(**kwargs)
+        self.num_labels, self.num_bins, self.average = num_labels, num_bins, average
+        self.add_state("pos_hist", default=torch.zeros(num_labels, num_bins), dist_reduce_fx="sum")
+        self.add_state("neg_hist", default=torch.zeros(num_labels, num_bins), dist_reduce_fx="sum")
+
+    def update(self, preds, target):
+        """Add a batch to the histograms - `preds` are logits and `target` 0/1 labels, both `(bs, num_labels)`"""
+        bins = (torch.sigmoid(preds.float()) * self.num_bins).long().clamp(0, self.num_bins - 1)
+        bins = bins + torch.arange(self.num_labels, device=bins.device) * self.num_bins
+        is_pos, size = target.bool(), self.num_labels * self.num_bins
+        self.pos_hist += torch.bincount(bins[is_pos], minlength=size).view_as(self.pos_hist)
+        self.neg_hist += torch.bincount(bins[~is_pos], minlength=size).view_as(self.neg_hist)
+
+    def _hists(self):
+        """Histograms per label, or summed over labels for `average="micro"`"""
+        pos, neg = self.pos_hist.double(), self.neg_hist.double()
+        if self.average == "micro":
+            return pos.sum(0, keepdim=True), neg.sum(0, keepdim=True)
+        return pos, neg
+
+    def _reduce(self, res):
+        if self.average == "micro":
+            return res[0]
+        return res.mean() if self.average == "macro" else res
+
+    def compute(self):
+        """AUROC - for each negative, count the positives in higher bins plus half of those in the same bin"""
+        pos, neg = self._hists()
+        pos_above = pos.sum(1, keepdim=True) - pos.cumsum(1)
+        auroc = (neg * (pos_above + 0.5 * pos)).sum(1) / (pos.sum(1) * neg.sum(1))
+        return self._reduce(auroc).float()
+
+    def max_error(self):
+        """Upper bound on the difference between `compute()` and the exact AUROC"""
+        pos, neg = self._hists()
+        return self._reduce((pos * neg).sum(1) / (2 * pos.sum(1) * neg.sum(1))).float()
+
+
+def get_auroc_metric(num_labels, auroc_bins=None):
+    """Exact (torchmetrics) AUROC, or `BinnedAUROC` with `auroc_bins` bins for constant memory"""
+    if auroc_bins:
+        return BinnedAUROC(num_labels, num_bins=auroc_bins, average="micro")
+    return AUROC(num_classes=num_labels, pos_label=1, average="micro")
 
 
 # Cell
@@ -119,6 +174,7 @@ class EHR_LSTM(pl.LightningModule):
         lstm_drp=0.3,
         linear_drp=0.3,
         zero_bn=False,
+        auroc_bins=None,
     ):
 
         super().__init__()
@@ -168,7 +224,7 @@ class EHR_LSTM(pl.LightningModule):
         metrics = MetricCollection(
             [
                 # Accuracy(),
-                AUROC(num_classes=num_labels, pos_label=1, average="micro"),
+                get_auroc_metric(num_labels, auroc_bins),
                 # Recall(),
                 # Precision(),
                 # AveragePrecision(num_classes)
@@ -179,54 +235,35 @@ class EHR_LSTM(pl.LightningModule):
         self.test_metrics = metrics.clone(prefix="test/")
 
 
-    def get_embs(self, ptbatch_recs, ptbatch_demogs, x):
-        for p in range(len(x)):  # for the batch of pts
-            ptbatch_recs[p] = torch.cat(
-                (
-                    self.embgs[0](x[p].obs_nums, x[p].obs_offsts),
-                    self.embgs[1](x[p].alg_nums, x[p].alg_offsts),
-                    self.embgs[2](x[p].crpl_nums, x[p].crpl_offsts),
-                    self.embgs[3](x[p].med_nums, x[p].med_offsts),
-                    self.embgs[4](x[p].img_nums, x[p].img_offsts),
-                    self.embgs[5](x[p].proc_nums, x[p].proc_offsts),
-                    self.embgs[6](x[p].cnd_nums, x[p].cnd_offsts),
-                    self.embgs[7](x[p].imm_nums, x[p].imm_offsts),
-                ),
-                dim=1,
-            )  # for the entire age span, example all 24 yrs
-
-            ptbatch_demogs[p] = torch.cat(
-                (
-                    self.embs[0](x[p].demographics[0]),
-                    self.embs[1](x[p].demographics[1]),
-                    self.embs[2](x[p].demographics[2]),
-                    self.embs[3](x[p].demographics[3]),
-                    self.embs[4](x[p].demographics[4]),
-                    self.embs[5](x[p].demographics[5]),
-                    self.embs[6](x[p].demographics[6]),
-                    self.embs[7](x[p].demographics[7]),
-                    self.embs[8](x[p].demographics[8]),
-                    self.embs[9](x[p].demographics[9]),
-                    self.embs[10](x[p].demographics[10]),
-                    x[p].age_now,
-                    torch.zeros(self.amp_pad, device=self.device),
-                )
-            )
+    def get_embs(self, x):
+        """Embed a `PatientBatch` - one `EmbeddingBag` call per record type
+        and one `Embedding` call per demographic for the whole batch"""
+        bs = len(x)
+        ptbatch_recs = torch.cat(
+            [
+                embg(rec_nums, rec_offsts).view(bs, -1, embg.embedding_dim)
+                for embg, rec_nums, rec_offsts in zip(self.embgs, x.nums, x.offsets)
+            ],
+            dim=2,
+        )  # for the entire age span, example all 24 yrs
+        ptbatch_demogs = torch.cat(
+            [emb(x.demographics[:, i]) for i, emb in enumerate(self.embs)]
+            + [x.age_now.float(), torch.zeros(bs, self.amp_pad, device=self.device)],
+            dim=1,
+        )
 
         return ptbatch_recs, ptbatch_demogs
 
 
     def forward(self, x):
+        """`x` is a `PatientBatch` (see `multimodal_collate`), or a list of `Patient`s which is collated here"""
+        if not isinstance(x, PatientBatch):
+            x = collate_patients(x)
 
         bs = len(x)
-        bptt = len(x[0].obs_offsts)
         h = torch.zeros(self.lstm_layers, bs, self.nh, device=self.device)
 
-        ptbatch_recs = torch.empty(bs, bptt, self.rec_wd, device=self.device)
-        ptbatch_demogs = torch.empty(
-            bs, self.demograph_wd + 1 + self.amp_pad, device=self.device
-        )
-        ptbatch_recs, ptbatch_demogs = self.get_embs(ptbatch_recs, ptbatch_demogs, x)
+        ptbatch_recs, ptbatch_demogs = self.get_embs(x)
 
         ptbatch_recs = self.input_dp(ptbatch_recs)  # apply input dropout
 
@@ -241,7 +278,7 @@ class EHR_LSTM(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         xb, yb = batch
-        xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(
+        xb, yb = xb.to(self.device, non_block=True), yb.to(
             self.device, non_blocking=True
         )
         y_hat = self(xb)
@@ -249,13 +286,12 @@ class EHR_LSTM(pl.LightningModule):
 
         self.log("train_loss", train_loss, on_step=True, on_epoch=True)
         self.train_metrics.update(y_hat, yb.int())
-        self.log_dict(self.train_metrics.compute(), on_step=False, on_epoch=True)
 
         return train_loss
 
     def validation_step(self, batch, batch_idx):
         xb, yb = batch
-        xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(
+        xb, yb = xb.to(self.device, non_block=True), yb.to(
             self.device, non_blocking=True
         )
         y_hat = self(xb)
@@ -263,13 +299,12 @@ class EHR_LSTM(pl.LightningModule):
 
         self.log("valid_loss", valid_loss, on_step=True, on_epoch=True)
         self.valid_metrics.update(y_hat, yb.int())
-        self.log_dict(self.valid_metrics.compute(), on_step=False, on_epoch=True)
 
         return valid_loss
 
     def test_step(self, batch, batch_idx):
         xb, yb = batch
-        xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(
+        xb, yb = xb.to(self.device, non_block=True), yb.to(
             self.device, non_blocking=True
         )
         y_hat = self(xb)
@@ -277,10 +312,23 @@ class EHR_LSTM(pl.LightningModule):
 
         # self.log("test_loss", test_loss, on_step=True, on_epoch=True)
         self.test_metrics.update(y_hat, yb.int())
-        self.log_dict(self.test_metrics.compute(), on_step=False, on_epoch=True)
 
         return
 
+    def _log_epoch_metrics(self, metrics):
+        """Compute metrics once per epoch (not per step - AUROC sorts all predictions seen so far) and reset"""
+        self.log_dict(metrics.compute())
+        metrics.reset()
+
+    def on_train_epoch_end(self):
+        self._log_epoch_metrics(self.train_metrics)
+
+    def on_validation_epoch_end(self):
+        self._log_epoch_metrics(self.valid_metrics)
+
+    def on_test_epoch_end(self):
+        self._log_epoch_metrics(self.test_metrics)
+
     def configure_optimizers(self):
         # optimizer
         if self.optim == "adam":
@@ -348,6 +396,7 @@ class EHR_CNN(pl.LightningModule):
         input_drp=0.3,
         linear_drp=0.3,
         zero_bn=False,
+        auroc_bins=None,
     ):
 
         super().__init__()
@@ -396,7 +445,7 @@ class EHR_CNN(pl.LightningModule):
         metrics = MetricCollection(
             [
                 # Accuracy(),
-                AUROC(num_classes=num_labels, pos_label=1, average="micro"),
+                get_auroc_metric(num_labels, auroc_bins),
                 # Recall(),
                 # Precision(),
                 # AveragePrecision(num_classes)
@@ -406,52 +455,35 @@ class EHR_CNN(pl.LightningModule):
         self.valid_metrics = metrics.clone(prefix="valid/")
         self.test_metrics = metrics.clone(prefix="test/")
 
-    def get_embs(self, ptbatch_recs, ptbatch_demogs, x):
-        for p in range(len(x)):  # for the batch of pts
-            ptbatch_recs[p] = torch.cat(
-                (
-                    self.embgs[0](x[p].obs_nums, x[p].obs_offsts),
-                    self.embgs[1](x[p].alg_nums, x[p].alg_offsts),
-                    self.embgs[2](x[p].crpl_nums, x[p].crpl_offsts),
-                    self.embgs[3](x[p].med_nums, x[p].med_offsts),
-                    self.embgs[4](x[p].img_nums, x[p].img_offsts),
-                    self.embgs[5](x[p].proc_nums, x[p].proc_offsts),
-                    self.embgs[6](x[p].cnd_nums, x[p].cnd_offsts),
-                    self.embgs[7](x[p].imm_nums, x[p].imm_offsts),
-                ),
-                dim=1,
-            )  # for the entire age span, example all 20 yrs
-            ptbatch_demogs[p] = torch.cat(
-                (
-                    self.embs[0](x[p].demographics[0]),
-                    self.embs[1](x[p].demographics[1]),
-                    self.embs[2](x[p].demographics[2]),
-                    self.embs[3](x[p].demographics[3]),
-                    self.embs[4](x[p].demographics[4]),
-                    self.embs[5](x[p].demographics[5]),
-                    self.embs[6](x[p].demographics[6]),
-                    self.embs[7](x[p].demographics[7]),
-                    self.embs[8](x[p].demographics[8]),
-                    self.embs[9](x[p].demographics[9]),
-                    self.embs[10](x[p].demographics[10]),
-                    x[p].age_now,
-                    torch.zeros(self.amp_pad, device=self.device),
-                )
-            )
+    def get_embs(self, x):
+        """Embed a `PatientBatch` - one `EmbeddingBag` call per record type
+        and one `Embedding` call per demographic for the whole batch"""
+        bs = len(x)
+        ptbatch_recs = torch.cat(
+            [
+                embg(rec_nums, rec_offsts).view(bs, -1, embg.embedding_dim)
+                for embg, rec_nums, rec_offsts in zip(self.embgs, x.nums, x.offsets)
+            ],
+            dim=2,
+        )  # for the entire age span, example all 20 yrs
+        ptbatch_demogs = torch.cat(
+            [emb(x.demographics[:, i]) for i, emb in enumerate(self.embs)]
+            + [x.age_now.float(), torch.zeros(bs, self.amp_pad, device=self.device)],
+            dim=1,
+        )
 
         return ptbatch_recs, ptbatch_demogs
 
     def forward(self, x):
+        """`x` is a `PatientBatch` (see `multimodal_collate`), or a list of `Patient`s which is collated here"""
+        if not isinstance(x, PatientBatch):
+            x = collate_patients(x)
 
         bs = len(x)
-        height = len(x[0].obs_offsts)
+        height = x.bptt
         width = self.rec_wd
 
-        ptbatch_recs = torch.empty(bs, height, width, device=self.device)
-        ptbatch_demogs = torch.empty(
-            bs, self.demograph_wd + 1 + self.amp_pad, device=self.device
-        )
-        ptbatch_recs, ptbatch_demogs = self.get_embs(ptbatch_recs, ptbatch_demogs, x)
+        ptbatch_recs, ptbatch_demogs = self.get_embs(x)
 
         ptbatch_recs = self.input_dp(ptbatch_recs)  # apply input dropout
 
@@ -465,7 +497,7 @@ class EHR_CNN(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         xb, yb = batch
-        xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(
+        xb, yb = xb.to(self.device, non_block=True), yb.to(
             self.device, non_blocking=True
         )
         y_hat = self(xb)
@@ -473,13 +505,12 @@ class EHR_CNN(pl.LightningModule):
 
         self.log("train_loss", train_loss, on_step=True, on_epoch=True)
         self.train_metrics.update(y_hat, yb.int())
-        self.log_dict(self.train_metrics.compute(), on_step=False, on_epoch=True)
 
         return train_loss
 
     def validation_step(self, batch, batch_idx):
         xb, yb = batch
-        xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(
+        xb, yb = xb.to(self.device, non_block=True), yb.to(
             self.device, non_blocking=True
         )
         y_hat = self(xb)
@@ -487,13 +518,12 @@ class EHR_CNN(pl.LightningModule):
 
         self.log("valid_loss", valid_loss, on_step=True, on_epoch=True)
         self.valid_metrics.update(y_hat, yb.int())
-        self.log_dict(self.valid_metrics.compute(), on_step=False, on_epoch=True)
 
         return valid_loss
 
     def test_step(self, batch, batch_idx):
         xb, yb = batch
-        xb, yb = [x.to_gpu(non_block=True) for x in xb], yb.to(
+        xb, yb = xb.to(self.device, non_block=True), yb.to(
             self.device, non_blocking=True
         )
         y_hat = self(xb)
@@ -501,10 +531,23 @@ class EHR_CNN(pl.LightningModule):
 
         # self.log("test_loss", test_loss, on_step=True, on_epoch=True)
         self.test_metrics.update(y_hat, yb.int())
-        self.log_dict(self.test_metrics.compute(), on_step=False, on_epoch=True)
 
         return
 
+    def _log_epoch_metrics(self, metrics):
+        """Compute metrics once per epoch (not per step - AUROC sorts all predictions seen so far) and reset"""
+        self.log_dict(metrics.compute())
+        metrics.reset()
+
+    def on_train_epoch_end(self):
+        self._log_epoch_metrics(self.train_metrics)
+
+    def on_validation_epoch_end(self):
+        self._log_epoch_metrics(self.valid_metrics)
+
+    def on_test_epoch_end(self):
+        self._log_epoch_metrics(self.test_metrics)
+
     def configure_optimizers(self):
         # optimizer
         if self.optim == "adam":
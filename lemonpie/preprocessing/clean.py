@@ -1,53 +1,117 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/01_preprocessing_clean.ipynb (unless otherwise specified).
 
-__all__ = ['read_raw_ehrdata', 'split_patients', 'split_ehr_dataset', 'cleanup_pts', 'cleanup_obs', 'cleanup_algs',
-           'cleanup_crpls', 'cleanup_meds', 'cleanup_img', 'cleanup_procs', 'cleanup_cnds', 'cleanup_immns',
-           'extract_ys', 'insert_age', 'clean_preprocess_dataset', 'persist_cleaned', 'clean_raw_ehrdata',
-           'load_cleaned_ehrdata', 'load_ehr_vocabcodes', 'test_extract_ys', 'get_label_counts', 'test_cleaned_ehrdata']
+__all__ = ['table_path', 'save_table', 'find_table', 'load_table', 'read_raw_ehrdata', 'hash_split_ids',
+           'split_patients', 'split_ehr_dataset', 'append_parquet', 'split_ehr_dataset_chunked', 'cleanup_pts',
+           'cleanup_obs', 'expand_start_stop', 'cleanup_algs', 'cleanup_crpls', 'cleanup_meds', 'cleanup_img',
+           'cleanup_procs', 'cleanup_cnds', 'cleanup_immns', 'extract_ys', 'insert_age', 'read_cleanup',
+           'persist_table', 'CLEANUP_FNS', 'TaskExecutor', 'RayExecutor', 'PoolExecutor', 'SerialExecutor',
+           'get_executor', 'run_tasks', 'EXECUTORS', 'object_store_usage', 'wait_stages', 'wait_stage',
+           'cleanup_dataset', 'preprocess_dataset', 'clean_preprocess_dataset', 'persist_cleaned', 'file_fingerprint',
+           'cleaning_fingerprints', 'changed_tables', 'clean_raw_ehrdata', 'load_cleaned_ehrdata', 'convert_csv_store',
+           'load_ehr_vocabcodes', 'test_extract_ys', 'get_label_counts', 'test_cleaned_ehrdata']
 
 # Cell
 from ..basics import *
 from fastai.imports import *
 import ray
+import hashlib, json
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as futures_wait
+
+# Cell
+def table_path(dir, name, fmt=None):
+    '''Path of table `name` in `dir` for storage format `fmt` ('csv' or 'parquet'), defaults to `STORAGE_FORMAT` setting'''
+    fmt = fmt or STORAGE_FORMAT
+    return Path(f'{dir}/{name}.{"parquet" if fmt == "parquet" else "csv"}')
+
+def save_table(df, dir, name, fmt=None, index=True, index_label=None, categorical=('code',)):
+    '''Save `df` as table `name` in `dir` - in Parquet, `categorical` columns are category-encoded and dates & ints stay typed'''
+    fpath = table_path(dir, name, fmt)
+    if fpath.suffix == '.csv':
+        df.to_csv(fpath, index=index, index_label=index_label)
+    else:
+        df = df.astype({col:'category' for col in categorical if col in df.columns})
+        if index_label is not None: df = df.rename_axis(index_label)
+        df.to_parquet(fpath, index=None if index else False)
+    return fpath
+
+def find_table(dir, name, fmt=None):
+    '''Path of table `name` in `dir` - in format `fmt` if saved so, else in the other one if that exists'''
+    fpath = table_path(dir, name, fmt)
+    if not fpath.exists():
+        other = table_path(dir, name, 'csv' if fpath.suffix == '.parquet' else 'parquet')
+        if other.exists(): fpath = other
+    return fpath
+
+def load_table(dir, name, columns=None, fmt=None, **csv_kwargs):
+    '''Load table `name` from `dir` - in format `fmt` if saved so, else the other one. Only `columns` (+ index) are read.'''
+    fpath = find_table(dir, name, fmt)
+    if fpath.suffix == '.parquet':
+        return pd.read_parquet(fpath, columns=columns)
+
+    csv_kwargs = {'low_memory':False, **csv_kwargs}
+    if columns is not None:
+        header = pd.read_csv(fpath, nrows=0).columns
+        index_col = csv_kwargs.get('index_col')
+        keep = set(columns) | ({header[index_col]} if index_col is not None else set())
+        csv_kwargs['usecols'] = [col for col in header if col in keep]
+    return pd.read_csv(fpath, **csv_kwargs)
 
 # Cell
 def read_raw_ehrdata(path, csv_names = FILENAMES):
     '''Read raw EHR data'''
-    dfs = [pd.read_csv(f'{path}/{fname}.csv', low_memory=False) for fname in csv_names]
+    dfs = [load_table(path, fname) for fname in csv_names]
     return dfs
 
 # Cell
-def split_patients(patients, valid_pct=0.2, test_pct=0.2, random_state=1234):
-    '''Split the patients dataframe'''
+def hash_split_ids(ids, valid_pct=0.2, test_pct=0.2, random_state=1234):
+    '''Split (0: train, 1: valid, 2: test) of each patient id, from a seeded hash of the id - stable, and holds for new patients'''
+    hashes = pd.util.hash_array(pd.Series(ids).astype(str).values.astype(object), hash_key=f'{random_state:016d}'[-16:])
+    return np.searchsorted([1 - (valid_pct + test_pct), 1 - test_pct], hashes / 2.0**64, side='right')
+
+# Cell
+def split_patients(patients, valid_pct=0.2, test_pct=0.2, random_state=1234, by_hash=False):
+    '''Split the patients dataframe - shuffle & slice, or by a seeded hash of patient id if `by_hash`'''
     train_pct = 1 - (valid_pct + test_pct)
     print(f'Splits:: train: {train_pct}, valid: {valid_pct}, test: {test_pct}')
+    if by_hash:
+        pt_splits = hash_split_ids(patients['id'], valid_pct, test_pct, random_state)
+        return [patients[pt_splits == i].reset_index(drop=True) for i in range(3)]
     patients = patients.sample(frac=1, random_state=random_state).reset_index(drop=True)
     return np.split(patients, [int(train_pct*len(patients)), int((train_pct+valid_pct)*len(patients))])
 
 # Cell
-def split_ehr_dataset(path, valid_pct=0.2, test_pct=0.2, random_state=1234):
-    '''Split EHR dataset into train, valid, test and save'''
+def split_ehr_dataset(path, valid_pct=0.2, test_pct=0.2, random_state=1234, chunksize=None, by_hash=False, names=None):
+    '''Split EHR dataset into train, valid, test and save - streaming the raw csvs in chunks if `chunksize` is given.
+    Patients are always split, record tables only if in `names` (all by default).'''
+
+    if chunksize is not None: return split_ehr_dataset_chunked(path, valid_pct, test_pct, random_state, chunksize, by_hash, names)
 
     train_dfs, valid_dfs, test_dfs = [],[],[]
 
-    dfs = read_raw_ehrdata(f'{path}/raw_original')
+    names = [FILENAMES[0]] + [name for name in FILENAMES[1:] if names is None or name in names]
+    dfs = read_raw_ehrdata(f'{path}/raw_original', names)
     all_pts = dfs[0]
     all_pts.rename(str.lower, axis='columns', inplace=True)
-    train_pt, valid_pt, test_pt = split_patients(dfs[0], valid_pct, test_pct, random_state)
+    train_pt, valid_pt, test_pt = split_patients(dfs[0], valid_pct, test_pct, random_state, by_hash)
     train_dfs.append(train_pt)
     valid_dfs.append(valid_pt)
     test_dfs.append(test_pt)
     print(f'Split {FILENAMES[0]} into:: Train: {len(train_pt)}, Valid: {len(valid_pt)}, Test: {len(test_pt)} -- Total before split: {len(dfs[0])}')
 
-    for df, name in zip(dfs[1:], FILENAMES[1:]):
-        df = df.set_index('PATIENT')
-        df_train = df.loc[df.index.intersection(train_pt['id']).unique()]
-        df_valid = df.loc[df.index.intersection(valid_pt['id']).unique()]
-        df_test = df.loc[df.index.intersection(test_pt['id']).unique()]
+    for df, name in zip(dfs[1:], names[1:]):
+        if by_hash:
+            pt_splits = hash_split_ids(df['PATIENT'], valid_pct, test_pct, random_state)
+            df_train, df_valid, df_test = [df[pt_splits == i] for i in range(3)]
+        else:
+            df = df.set_index('PATIENT')
+            df_train = df.loc[df.index.intersection(train_pt['id']).unique()].reset_index()
+            df_valid = df.loc[df.index.intersection(valid_pt['id']).unique()].reset_index()
+            df_test = df.loc[df.index.intersection(test_pt['id']).unique()].reset_index()
         assert len(df) == len(df_train)+len(df_valid)+len(df_test),f'Split failed {name}: {len(df)} != {len(df_train)}+{len(df_valid)}+{len(df_test)}'
-        train_dfs.append(df_train.reset_index())
-        valid_dfs.append(df_valid.reset_index())
-        test_dfs.append(df_test.reset_index())
+        train_dfs.append(df_train)
+        valid_dfs.append(df_valid)
+        test_dfs.append(df_test)
 
 
     for split in ['train', 'valid', 'test']:
@@ -55,22 +119,83 @@ def split_ehr_dataset(path, valid_pct=0.2, test_pct=0.2, random_state=1234):
         d.mkdir(parents=True, exist_ok=True)
 
         if split == 'train':
-            for df, name in zip(train_dfs, FILENAMES):
-                df.to_csv(f'{d}/{name}.csv', index=False)
+            for df, name in zip(train_dfs, names):
+                save_table(df, d, name, index=False, categorical=())
             print(f'Saved train data to {d}')
 
         if split == 'valid':
-            for df, name in zip(valid_dfs, FILENAMES):
-                df.to_csv(f'{d}/{name}.csv', index=False)
+            for df, name in zip(valid_dfs, names):
+                save_table(df, d, name, index=False, categorical=())
             print(f'Saved valid data to {d}')
 
         if split == 'test':
-            for df, name in zip(test_dfs, FILENAMES):
-                df.to_csv(f'{d}/{name}.csv', index=False)
+            for df, name in zip(test_dfs, names):
+                save_table(df, d, name, index=False, categorical=())
             print(f'Saved test data to {d}')
 
 # Cell
-@ray.remote(num_returns=3)
+def append_parquet(writer, df, fpath):
+    '''Append `df` to the Parquet file at `fpath` - `writer` is the `pyarrow.parquet.ParquetWriter` returned by the previous call
+    (`None` to start the file). The first non-empty `df` sets the schema (columns with no values in it as strings), later ones are cast to it.'''
+    import pyarrow as pa, pyarrow.parquet as pq # only needed for Parquet, like `DataFrame.to_parquet`
+    table = pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata(None)
+    if writer is None:
+        if len(table) == 0: return None
+        schema = pa.schema([pa.field(col.name, pa.string()) if table.column(col.name).null_count == len(table) else col
+                            for col in table.schema])
+        writer = pq.ParquetWriter(fpath, schema)
+    try: writer.write_table(table.cast(writer.schema))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        raise Exception(f'Chunk of {fpath} does not fit the schema of the chunks before it ({e}) - split with a bigger `chunksize`, or as csv and convert with `convert_csv_store`')
+    return writer
+
+# Cell
+def split_ehr_dataset_chunked(path, valid_pct=0.2, test_pct=0.2, random_state=1234, chunksize=1_000_000, by_hash=False, names=None):
+    '''Split EHR dataset into train, valid, test and save - record csvs are read `chunksize` rows at a time
+    and each chunk's rows are appended to their split's table (csv, or Parquet through `append_parquet` if the
+    `STORAGE_FORMAT` setting is 'parquet'), so memory use is bounded by the chunk size'''
+
+    dirs = [Path(f'{path}/raw_split/{split}') for split in ['train', 'valid', 'test']]
+    for d in dirs: d.mkdir(parents=True, exist_ok=True)
+
+    all_pts = load_table(f'{path}/raw_original', FILENAMES[0])
+    all_pts.rename(str.lower, axis='columns', inplace=True)
+    split_pts = split_patients(all_pts, valid_pct, test_pct, random_state, by_hash)
+    for df, d in zip(split_pts, dirs):
+        save_table(df, d, FILENAMES[0], index=False, categorical=())
+    print(f'Split {FILENAMES[0]} into:: Train: {len(split_pts[0])}, Valid: {len(split_pts[1])}, Test: {len(split_pts[2])} -- Total before split: {len(all_pts)}')
+
+    # patient -> split lookup (a hash map over patient ids)
+    pt_ids = pd.Index(pd.concat([df['id'] for df in split_pts]))
+    pt_splits = np.repeat(np.arange(3), [len(df) for df in split_pts])
+
+    for name in [name for name in FILENAMES[1:] if names is None or name in names]:
+        for d in dirs:
+            for fmt in ['csv', 'parquet']:
+                if table_path(d, name, fmt).exists(): table_path(d, name, fmt).unlink()
+
+        counts = np.zeros(3, dtype=np.int64)
+        writers = [None] * len(dirs) # Parquet writers
+        for i, chunk in enumerate(pd.read_csv(f'{path}/raw_original/{name}.csv', chunksize=chunksize, low_memory=False)):
+            if by_hash: chunk_splits = hash_split_ids(chunk['PATIENT'], valid_pct, test_pct, random_state)
+            else:
+                pos = pt_ids.get_indexer(chunk['PATIENT'])
+                assert (pos >= 0).all(), f'Split failed {name}: {(pos < 0).sum()} rows of unknown patients'
+                chunk_splits = pt_splits[pos]
+            for split_idx, d in enumerate(dirs):
+                part = chunk[chunk_splits == split_idx]
+                if STORAGE_FORMAT == 'parquet': writers[split_idx] = append_parquet(writers[split_idx], part, table_path(d, name, 'parquet'))
+                else: part.to_csv(table_path(d, name, 'csv'), mode='a', header=(i == 0), index=False)
+                counts[split_idx] += len(part)
+            if i == 0: empty = chunk.iloc[:0]
+        for writer, d in zip(writers, dirs):
+            if writer is not None: writer.close()
+            elif STORAGE_FORMAT == 'parquet': save_table(empty, d, name, 'parquet', index=False, categorical=()) # no rows in this split
+        print(f'Split {name} into:: Train: {counts[0]}, Valid: {counts[1]}, Test: {counts[2]} -- Total before split: {counts.sum()}')
+
+    print(f'Saved split data to {Path(f"{path}/raw_split")}')
+
+# Cell
 def cleanup_pts(pts, is_train, today=None):
     '''Clean patients df'''
 
@@ -92,7 +217,6 @@ def cleanup_pts(pts, is_train, today=None):
     return [patients, pt_demographics, pt_codes] if is_train else [patients, pt_demographics, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_obs(obs, is_train):
     '''Clean observations df'''
 
@@ -103,7 +227,7 @@ def cleanup_obs(obs, is_train):
     obs.rename(columns={"code":"orig_code", "description":"desc"}, inplace=True)
     obs['code'] = obs['orig_code'].str.cat(obs[['value', 'units', 'type']].astype(str), sep='||')
 
-    if is_train: obs_codes = obs.loc[:, ['orig_code', 'desc', 'value', 'units', 'type']]
+    if is_train: obs_codes = obs.loc[:, ['orig_code', 'desc', 'value', 'units', 'type']].drop_duplicates()
 
     obs = obs.loc[:, ['patient', 'date', 'code']]
     obs = obs.astype({'date':'datetime64'})
@@ -112,23 +236,34 @@ def cleanup_obs(obs, is_train):
     return [obs, obs_codes] if is_train else [obs, None]
 
 # Cell
-@ray.remote(num_returns=2)
+def expand_start_stop(df, categorical=False):
+    '''Expand records with `start` & `stop` dates into events - a `code||START` row for each record (on its `date`)
+    and a `code||STOP` row for each record that has a `stop` - vectorized, optionally with a categorical `code`'''
+    has_stop = df['stop'].notnull().values
+
+    # build event strings once per unique code, then take them for all rows
+    code_idx, uniques = pd.factorize(df['code'].fillna('nan'))
+    uniques = pd.Index(uniques).astype(str)
+    event_codes = (uniques + '||START').append(uniques + '||STOP')
+    code_idx = np.concatenate([code_idx, code_idx[has_stop] + len(uniques)])
+
+    starts = df.drop(columns=['stop', 'code']).rename(columns={'start':'date'})
+    stops = df.loc[has_stop].drop(columns=['start', 'code']).rename(columns={'stop':'date'})
+    events = pd.concat([starts, stops], ignore_index=True)
+    events.insert(df.columns.drop('stop').get_loc('code'), 'code',
+                  pd.Categorical.from_codes(code_idx, event_codes) if categorical else event_codes.values[code_idx])
+    return events
+
+# Cell
 def cleanup_algs(allergies, is_train):
     '''Clean allergies df'''
 
     allergies.rename(str.lower, axis='columns', inplace=True)
     allergies.drop(columns=['encounter'], inplace=True)
 
-    stops = pd.DataFrame(allergies.loc[allergies['stop'].notnull(),:])
-    allergies['code'] = allergies['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    allergies.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    allergies.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date", "description":"desc"}, inplace=True)
-    allergies = allergies.append(stops, ignore_index=True)
+    allergies = expand_start_stop(allergies).rename(columns={"description":"desc"})
 
-    if is_train: alg_codes = allergies.loc[:, ['code', 'desc']]
+    if is_train: alg_codes = allergies.loc[:, ['code', 'desc']].drop_duplicates()
 
     allergies.drop(columns=['desc'], inplace=True)
     allergies = allergies.astype({'date':'datetime64'})
@@ -136,23 +271,15 @@ def cleanup_algs(allergies, is_train):
     return [allergies, alg_codes] if is_train else [allergies, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_crpls(careplans, is_train):
     '''Clean careplans df'''
 
     careplans.rename(str.lower, axis='columns', inplace=True)
     careplans = careplans.loc[:, ['start', 'stop', 'patient', 'code', 'description']]
 
-    stops = pd.DataFrame(careplans.loc[careplans['stop'].notnull(),:])
-    careplans['code'] = careplans['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    careplans.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    careplans.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date", "description":"desc"}, inplace=True)
-    careplans = careplans.append(stops, ignore_index=True)
+    careplans = expand_start_stop(careplans).rename(columns={"description":"desc"})
 
-    if is_train: crpl_codes = careplans.loc[:, ['code', 'desc']]
+    if is_train: crpl_codes = careplans.loc[:, ['code', 'desc']].drop_duplicates()
 
     careplans.drop(columns=['desc'], inplace=True)
     careplans = careplans.astype({'date':'datetime64'})
@@ -160,23 +287,15 @@ def cleanup_crpls(careplans, is_train):
     return [careplans, crpl_codes] if is_train else [careplans, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_meds(medications, is_train):
     '''Clean `medications` df'''
 
     medications.rename(str.lower, axis='columns', inplace=True)
     medications = medications.loc[:, ['start', 'stop', 'patient', 'code', 'description']]
 
-    stops = pd.DataFrame(medications.loc[medications['stop'].notnull(),:])
-    medications['code'] = medications['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    medications.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    medications.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date", "description":"desc"}, inplace=True)
-    medications = medications.append(stops, ignore_index=True)
+    medications = expand_start_stop(medications).rename(columns={"description":"desc"})
 
-    if is_train: med_codes = medications.loc[:, ['code', 'desc']]
+    if is_train: med_codes = medications.loc[:, ['code', 'desc']].drop_duplicates()
 
     medications.drop(columns=['desc'], inplace=True)
     medications = medications.astype({'date':'datetime64'})
@@ -184,13 +303,12 @@ def cleanup_meds(medications, is_train):
     return [medications, med_codes] if is_train else [medications, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_img(imaging_studies, is_train):
     '''Clean `imaging` df'''
 
     imaging_studies.rename(str.lower, axis='columns', inplace=True)
     imaging_studies.rename(columns={"bodysite_code":"code", "bodysite_description":"desc"}, inplace=True)
-    if is_train: img_codes = imaging_studies.loc[:, ['code', 'desc']]
+    if is_train: img_codes = imaging_studies.loc[:, ['code', 'desc']].drop_duplicates()
 
     imaging_studies = imaging_studies.loc[:, ['patient', 'date', 'code']]
     imaging_studies = imaging_studies.astype({'date':'datetime64'})
@@ -198,13 +316,12 @@ def cleanup_img(imaging_studies, is_train):
     return [imaging_studies, img_codes] if is_train else [imaging_studies, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_procs(procedures, is_train):
     '''Clean `procedures` df'''
 
     procedures.rename(str.lower, axis='columns', inplace=True)
     procedures.rename(columns={"description":"desc"}, inplace=True)
-    if is_train: proc_codes = procedures.loc[:, ['code', 'desc']]
+    if is_train: proc_codes = procedures.loc[:, ['code', 'desc']].drop_duplicates()
 
     procedures = procedures.loc[:, ['patient', 'date', 'code']]
     procedures = procedures.astype({'date':'datetime64'})
@@ -212,22 +329,14 @@ def cleanup_procs(procedures, is_train):
     return [procedures, proc_codes] if is_train else [procedures, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_cnds(conditions, is_train):
     '''Clean `conditions` df'''
 
     conditions.rename(str.lower, axis='columns', inplace=True)
     conditions.drop(columns=['encounter'], inplace=True)
-    stops = pd.DataFrame(conditions.loc[conditions['stop'].notnull(),:])
-    conditions['code'] = conditions['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    conditions.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    conditions.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date","description":"desc"}, inplace=True)
-    conditions = conditions.append(stops, ignore_index=True)
+    conditions = expand_start_stop(conditions).rename(columns={"description":"desc"})
 
-    if is_train: cnd_codes = conditions.loc[:, ['code', 'desc']]
+    if is_train: cnd_codes = conditions.loc[:, ['code', 'desc']].drop_duplicates()
 
     conditions.drop(columns=['desc'], inplace=True)
     conditions = conditions.astype({'date':'datetime64'})
@@ -235,13 +344,12 @@ def cleanup_cnds(conditions, is_train):
     return [conditions, cnd_codes] if is_train else [conditions, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_immns(immunizations, is_train):
     '''Clean `immunizations` df'''
 
     immunizations.rename(str.lower, axis='columns', inplace=True)
     immunizations.rename(columns={"description":"desc"}, inplace=True)
-    if is_train: imm_codes = immunizations.loc[:, ['code', 'desc']]
+    if is_train: imm_codes = immunizations.loc[:, ['code', 'desc']].drop_duplicates()
 
     immunizations = immunizations.loc[:, ['patient', 'date', 'code']]
     immunizations = immunizations.astype({'date':'datetime64'})
@@ -249,18 +357,24 @@ def cleanup_immns(immunizations, is_train):
     return [immunizations, imm_codes] if is_train else [immunizations, None]
 
 # Cell
-@ray.remote
 def extract_ys(patients, conditions, cnd_dict):
-    '''Extract labels from conditions df and add them to patients df with age.'''
-    for key in cnd_dict.keys():
-        patients = patients.merge(conditions[conditions.code==f'{cnd_dict[key]}||START'], how='left', left_index=True, right_index=True)
-        patients[f'{key}'] = patients.code.notna()
-        patients[f'{key}_age'] = ((patients.date - patients.birthdate)//np.timedelta64(1,'Y'))
-        patients = patients.drop(columns=['date','code'])
-    return patients
+    '''Extract labels from conditions df and add them to patients df with age (at first onset) - in a single pass over conditions'''
+    start_codes = {key: f'{code}||START' for key, code in cnd_dict.items()}
+    cnds = conditions.loc[conditions.code.isin(list(start_codes.values())), ['code', 'date']]
+    cnds = cnds.astype({'code':str})
+
+    # first onset date of each label code for each patient - patients x codes
+    onsets = cnds.groupby([cnds.index, 'code'])['date'].min().unstack('code')
+    onsets = onsets.reindex(index=patients.index, columns=pd.unique(list(start_codes.values()))).astype('datetime64[ns]')
+    onset_ages = onsets.sub(patients.birthdate, axis=0)//np.timedelta64(1,'Y')
+
+    labels = {}
+    for key, code in start_codes.items():
+        labels[f'{key}'] = onsets[code].notna()
+        labels[f'{key}_age'] = onset_ages[code]
+    return pd.concat([patients, pd.DataFrame(labels, index=patients.index)], axis=1)
 
 # Cell
-@ray.remote
 def insert_age(df, pts_df):
     '''Insert age in years and months into each of the rec dfs'''
 
@@ -270,114 +384,340 @@ def insert_age(df, pts_df):
     return df.drop(columns=['birthdate'])
 
 # Cell
-@ray.remote(num_returns=2)
-def clean_preprocess_dataset(path, is_train, conditions_dict, today=None):
-    '''Cleans and preprocesses all dfs in a single split'''
-    dfs = read_raw_ehrdata(path)
-
-    pt_data   = cleanup_pts.remote(dfs[0],   is_train, today)
-    obs_data  = cleanup_obs.remote(dfs[1],   is_train)
-    alg_data  = cleanup_algs.remote(dfs[2],  is_train)
-    crpl_data = cleanup_crpls.remote(dfs[3], is_train)
-    med_data  = cleanup_meds.remote(dfs[4],  is_train)
-    img_data  = cleanup_img.remote(dfs[5],   is_train)
-    proc_data = cleanup_procs.remote(dfs[6], is_train)
-    cnd_data  = cleanup_cnds.remote(dfs[7],  is_train)
-    imm_data  = cleanup_immns.remote(dfs[8], is_train)
+CLEANUP_FNS = [cleanup_pts, cleanup_obs, cleanup_algs, cleanup_crpls, cleanup_meds, cleanup_img, cleanup_procs, cleanup_cnds, cleanup_immns]
 
-    data_tables = [pt_data[0], pt_data[1], obs_data[0], alg_data[0], crpl_data[0], med_data[0], img_data[0], proc_data[0], cnd_data[0], imm_data[0]]
+def read_cleanup(path, table_idx, is_train, today=None):
+    '''Read raw table `FILENAMES[table_idx]` from split dir `path` and clean it with its `cleanup_*` function'''
+    df = load_table(path, FILENAMES[table_idx])
+    if table_idx == 0: return cleanup_pts(df, is_train, today)
+    return CLEANUP_FNS[table_idx](df, is_train)
 
-    patients, patient_demographics, conditions, rec_tables = data_tables[0], data_tables[1], data_tables[8], data_tables[2:]
-    rec_dfs = [insert_age.remote(rec_df, patients) for rec_df in rec_tables]
-    patients = extract_ys.remote(patients, conditions, conditions_dict)
+def persist_table(df, dir, name, reset_index=False, **kwargs):
+    '''Save a cleaned table - moving its index into a column first if `reset_index`'''
+    if reset_index: df = df.reset_index()
+    return save_table(df, dir, name, **kwargs)
 
-    data_tables = [patients, patient_demographics]
-    data_tables.extend(rec_dfs)
+# Cell
+class TaskExecutor(ABC):
+    '''Runs the tasks of the cleaning pipeline - `submit` returns handles (one per return value)
+    which can be passed as args to later tasks, or fetched with `get`'''
+    name = None
+    @abstractmethod
+    def submit(self, fn, *args, num_returns=1, **kwargs):
+        '''Submit task `fn(*args, **kwargs)` - args may be handles of other tasks' results'''
+    @abstractmethod
+    def get(self, refs):
+        '''Results of handle (or list of handles) `refs`'''
+    @abstractmethod
+    def wait(self, refs, timeout=None):
+        '''Wait up to `timeout` secs for `refs`, returning the ones (of `refs`) not yet ready'''
+    def usage(self):
+        '''Memory used to hold task results in MiB, if known'''
+        return None
+    def shutdown(self): pass
+    def __repr__(self): return f'{self.__class__.__name__}()'
+
+class RayExecutor(TaskExecutor):
+    '''Run tasks as Ray tasks - results stay in the object store & are passed by ref'''
+    name = 'ray'
+    def __init__(self): self._tasks = {}
+    def submit(self, fn, *args, num_returns=1, **kwargs):
+        if fn not in self._tasks: self._tasks[fn] = ray.remote(fn)
+        return self._tasks[fn].options(num_returns=num_returns).remote(*args, **kwargs)
+    def get(self, refs): return ray.get(refs)
+    def wait(self, refs, timeout=None):
+        if len(refs) == 0: return []
+        not_ready = set(ray.wait(refs, num_returns=len(refs), timeout=timeout)[1])
+        return [r for r in refs if r in not_ready]
+    def usage(self): return object_store_usage()
+
+class _PoolRef:
+    '''Handle to (one of) the return value(s) of a task submitted to a `PoolExecutor`'''
+    def __init__(self, future, idx=None): self.future, self.idx = future, idx
+    def result(self):
+        res = self.future.result()
+        return res if self.idx is None else res[self.idx]
+
+class PoolExecutor(TaskExecutor):
+    '''Run tasks in a `ProcessPoolExecutor` - `submit` returns right away, a dispatcher thread sends the task to the pool
+    once its input handles are resolved. Tasks are submitted after the ones they depend on, so dispatchers never wait on a queued one.'''
+    name = 'process'
+    def __init__(self, n_workers=None):
+        self.pool = ProcessPoolExecutor(max_workers=n_workers)
+        self.dispatch = ThreadPoolExecutor(max_workers=4 * self.pool._max_workers)
+    def _run(self, fn, args, kwargs):
+        args = [arg.result() if isinstance(arg, _PoolRef) else arg for arg in args]
+        kwargs = {k: v.result() if isinstance(v, _PoolRef) else v for k, v in kwargs.items()}
+        return self.pool.submit(fn, *args, **kwargs).result()
+    def submit(self, fn, *args, num_returns=1, **kwargs):
+        future = self.dispatch.submit(self._run, fn, args, kwargs)
+        return _PoolRef(future) if num_returns == 1 else [_PoolRef(future, i) for i in range(num_returns)]
+    def get(self, refs): return [self.get(r) for r in refs] if isinstance(refs, list) else refs.result()
+    def wait(self, refs, timeout=None):
+        futures_wait({r.future for r in refs}, timeout=timeout)
+        return [r for r in refs if not r.future.done()]
+    def shutdown(self):
+        self.dispatch.shutdown()
+        self.pool.shutdown()
+    def __repr__(self): return f'{self.__class__.__name__}(n_workers={self.pool._max_workers})'
+
+class SerialExecutor(TaskExecutor):
+    '''Run tasks in-process, one at a time as they are submitted - no startup cost, and simple to profile'''
+    name = 'serial'
+    def submit(self, fn, *args, num_returns=1, **kwargs):
+        res = fn(*args, **kwargs)
+        return res if num_returns == 1 else list(res)
+    def get(self, refs): return refs
+    def wait(self, refs, timeout=None): return []
+
+EXECUTORS = {ex.name: ex for ex in [RayExecutor, PoolExecutor, SerialExecutor]}
+
+def get_executor(executor=None):
+    '''`TaskExecutor` for `executor` - an instance, or one of 'ray', 'process', 'serial' - defaults to the `EXECUTOR` setting'''
+    if isinstance(executor, TaskExecutor): return executor
+    executor = executor or EXECUTOR
+    if executor not in EXECUTORS: raise Exception(f'Unknown executor "{executor}", should be one of {list(EXECUTORS.keys())}')
+    return EXECUTORS[executor]()
+
+def _fetch_results(refs, executor):
+    if refs is None: return None
+    if isinstance(refs, (list, tuple)): return type(refs)(_fetch_results(r, executor) for r in refs)
+    return executor.get(refs)
+
+def run_tasks(submit, executor=None):
+    '''Run `submit(executor)`, which submits tasks & returns (lists of) their handles. Given a `TaskExecutor` instance, the caller
+    owns it and gets the handles - else an executor is created for just this call (see `get_executor`), and shut down once
+    the results are fetched, which are returned instead.'''
+    if isinstance(executor, TaskExecutor): return submit(executor)
+    executor = get_executor(executor)
+    try: return _fetch_results(submit(executor), executor)
+    finally: executor.shutdown()
 
-    if is_train:
-        code_tables = [pt_data[2], obs_data[1], alg_data[1], crpl_data[1], med_data[1], img_data[1], proc_data[1], cnd_data[1], imm_data[1]]
+# Cell
+def object_store_usage():
+    '''Ray object store (plasma) memory in use in MiB, from ray's memory summary - `None` if not available'''
+    try:
+        try   : from ray.internal.internal_api import memory_summary # ray 1.x
+        except ImportError: from ray._private.internal_api import memory_summary
+        res = re.search(r'Plasma memory usage (\d+) MiB', memory_summary(stats_only=True))
+        return int(res.group(1)) if res else None
+    except Exception:
+        return None
+
+def wait_stages(stages, executor, poll_secs=0.5):
+    '''Wait for the refs of all pipeline `stages` (dict of stage name to refs), submitted together so that the stages overlap -
+    a stage's peak memory usage (if known) is recorded while any of its refs are pending. Refs are dropped from `stages` as they
+    complete, so their results can be freed.'''
+    usage = executor.usage()
+    peaks = {stage: usage for stage in stages}
+    report = lambda stage: print(f'Completed - {stage} :: peak object store usage: {"n/a" if peaks[stage] is None else f"{peaks[stage]} MiB"}')
+    for stage, refs in stages.items():
+        stages[stage] = [r for r in refs if r is not None]
+        if len(stages[stage]) == 0: report(stage)
+    while any(len(refs) > 0 for refs in stages.values()):
+        pending = list({id(r): r for refs in stages.values() for r in refs}.values()) # stages may share refs
+        not_ready = {id(r) for r in executor.wait(pending, timeout=poll_secs)}
+        usage = executor.usage()
+        for stage, refs in stages.items():
+            if len(refs) == 0: continue
+            if usage is not None: peaks[stage] = max(peaks[stage] or 0, usage)
+            stages[stage] = [r for r in refs if id(r) in not_ready]
+            if len(stages[stage]) == 0: report(stage)
+    return peaks
+
+def wait_stage(stage, refs, executor, poll_secs=0.5):
+    '''Wait for all `refs` of a pipeline `stage` to be ready, reporting the stage's peak memory usage if known'''
+    return wait_stages({stage: refs}, executor, poll_secs)[stage]
 
-    return (data_tables, code_tables) if is_train else (data_tables, None)
+# Cell
+def cleanup_dataset(path, is_train, today=None, executor=None, names=None):
+    '''Submit cleanup tasks for all tables in a single split - each task reads its own raw table from `path`.
+    Patients are always cleaned, record tables only if in `names` (all by default) - `None` for the others.
+    Returns the data & code tables - as handles if `executor` is a `TaskExecutor` instance (see `run_tasks`).'''
+    def submit(executor):
+        pt_data = executor.submit(read_cleanup, path, 0, is_train, today, num_returns=3)
+        rec_data = [executor.submit(read_cleanup, path, i, is_train, num_returns=2) if names is None or FILENAMES[i] in names else [None, None]
+                    for i in range(1, len(FILENAMES))]
+
+        data_tables = [pt_data[0], pt_data[1]] + [rec[0] for rec in rec_data]
+        code_tables = [pt_data[2]] + [rec[1] for rec in rec_data] if is_train else None
+        return data_tables, code_tables
+    return run_tasks(submit, executor)
+
+def preprocess_dataset(data_tables, conditions_dict, executor=None):
+    '''Submit tasks to insert age into the record tables & extract labels - all share the one birthdates table by ref.
+    Returns handles if `executor` is a `TaskExecutor` instance, else the tables (see `run_tasks`).'''
+    def submit(executor):
+        birthdates, patient_demographics, conditions, rec_tables = data_tables[0], data_tables[1], data_tables[8], data_tables[2:]
+        rec_dfs = [executor.submit(insert_age, rec_df, birthdates) if rec_df is not None else None for rec_df in rec_tables]
+        patients = executor.submit(extract_ys, birthdates, conditions, conditions_dict) if conditions is not None else None
+        return [patients, patient_demographics] + rec_dfs
+    return run_tasks(submit, executor)
+
+def clean_preprocess_dataset(path, is_train, conditions_dict, today=None, executor=None):
+    '''Cleans and preprocesses all dfs in a single split - returns the data & code tables (handles if `executor` is a `TaskExecutor`)'''
+    def submit(executor):
+        data_tables, code_tables = cleanup_dataset(path, is_train, today, executor)
+        return preprocess_dataset(data_tables, conditions_dict, executor), code_tables
+    return run_tasks(submit, executor)
 
 # Cell
-@ray.remote
-def persist_cleaned(path, split_name, cleaned_dfs, code_tables=None):
-    '''Save cleaned EHR data to disk'''
+def persist_cleaned(path, split_name, cleaned_dfs, code_tables=None, executor=None):
+    '''Submit tasks saving cleaned EHR data (handles) to disk - returns the saved paths (handles if `executor` is a `TaskExecutor`)'''
     csv_names = FILENAMES.copy()
     csv_names.insert(1,'patient_demographics')
 
     cleaned_dir = Path(f'{path}/cleaned/{split_name}')
     cleaned_dir.mkdir(parents=True, exist_ok=True)
 
-    cleaned_dfs = ray.get(cleaned_dfs)
-
-    patients = cleaned_dfs[0]
-    patients.reset_index(inplace=True)
-    patients.to_csv(f'{cleaned_dir}/patients.csv', index_label='indx')
-
-    for df, name in zip(cleaned_dfs[1:], csv_names[1:]):
-        df.to_csv(f'{cleaned_dir}/{name}.csv')
-
-    print(f'Saved cleaned "{split_name}" data to {cleaned_dir}')
+    def submit(executor):
+        saved = [executor.submit(persist_table, cleaned_dfs[0], cleaned_dir, 'patients', reset_index=True, index_label='indx')] if cleaned_dfs[0] is not None else []
+        saved += [executor.submit(persist_table, df, cleaned_dir, name) for df, name in zip(cleaned_dfs[1:], csv_names[1:]) if df is not None]
 
-    if split_name == 'train':
-        codes_dir = Path(f'{cleaned_dir}/codes')
-        codes_dir.mkdir(parents=True, exist_ok=True)
+        if split_name == 'train':
+            codes_dir = Path(f'{cleaned_dir}/codes')
+            codes_dir.mkdir(parents=True, exist_ok=True)
+            saved += [executor.submit(persist_table, code_df, codes_dir, f'code_{name}', index_label='indx', categorical=())
+                      for code_df, name in zip(code_tables, FILENAMES) if code_df is not None]
+        return saved
+    return run_tasks(submit, executor)
 
-        code_tables = ray.get(code_tables)
-        for code_df,name in zip(code_tables, FILENAMES):
-            code_df.to_csv(f'{codes_dir}/code_{name}.csv', index_label='indx')
-        print(f'Saved vocab code tables to {codes_dir}')
-    return split_name
+# Cell
+def file_fingerprint(fpath, block_size=2**20):
+    '''Content hash (md5) of the file at `fpath`'''
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''): md5.update(block)
+    return md5.hexdigest()
+
+def cleaning_fingerprints(path, valid_pct, test_pct, conditions_dict, today=None, by_hash=False):
+    '''Fingerprints of the raw inputs & params each cleaned table depends on - all tables depend on the raw patients
+    table (for the split & birthdates), the split params and the `STORAGE_FORMAT` they're saved in, `patients` (demographics & labels)
+    also on `today`, `conditions_dict` & the raw conditions table. `today=None` (the current date) is fingerprinted as is, so that
+    patients are not re-cleaned every day - pass the date to re-clean them for it.'''
+    raw = {name: file_fingerprint(find_table(f'{path}/raw_original', name, 'csv')) for name in FILENAMES}
+    today = None if today is None else str(pd.to_datetime(today).date())
+    split_params = {'patients': raw[FILENAMES[0]], 'valid_pct': valid_pct, 'test_pct': test_pct, 'by_hash': by_hash,
+                    'storage_format': STORAGE_FORMAT}
+
+    deps = {name: {**split_params, name: raw[name]} for name in FILENAMES[1:]}
+    deps[FILENAMES[0]] = {**split_params, 'today': today, 'conditions_dict': conditions_dict, FILENAMES[7]: raw[FILENAMES[7]]}
+    return {name: hashlib.md5(json.dumps(deps[name], sort_keys=True).encode()).hexdigest() for name in FILENAMES}
+
+def changed_tables(path, fingerprints):
+    '''Tables whose `fingerprints` differ from the ones saved with the cleaned data in `path`, or whose cleaned data is missing'''
+    fpath = Path(f'{path}/cleaned/fingerprints.json')
+    saved = json.loads(fpath.read_text()) if fpath.exists() else {}
+    is_saved = lambda name: all(table_path(f'{path}/cleaned/{split}', name).exists() for split in ['train', 'valid', 'test'])
+    changed = [name for name in FILENAMES if saved.get(name) != fingerprints[name] or not is_saved(name)]
+
+    # patients' labels come from conditions & conditions need patients' birthdates - so they're redone together
+    if FILENAMES[0] in changed or FILENAMES[7] in changed: changed = list(dict.fromkeys(changed + [FILENAMES[0], FILENAMES[7]]))
+    return changed
 
 # Cell
-def clean_raw_ehrdata(path, valid_pct, test_pct, conditions_dict, today=None):
-    '''Split, clean, preprocess raw EHR data & save cleaned data to disk'''
+def clean_raw_ehrdata(path, valid_pct, test_pct, conditions_dict, today=None, chunksize=None, split_by_hash=False, executor=None, incremental=False):
+    '''Split, clean, preprocess raw EHR data & save cleaned data to disk - tasks run on `executor` ('ray', 'process' or 'serial').
+    If `incremental`, only tables whose raw inputs or cleaning params changed since the last run are re-split & re-cleaned.
+    All stages are submitted at once and overlap - returns the peak object store usage (MiB, `None` if not known) while each ran.'''
+
+    fingerprints = cleaning_fingerprints(path, valid_pct, test_pct, conditions_dict, today, split_by_hash)
+    changed = changed_tables(path, fingerprints) if incremental else FILENAMES.copy()
+    if len(changed) == 0:
+        print(f'Cleaned data in {Path(f"{path}/cleaned")} is up to date, nothing to re-clean')
+        return {}
+    print(f'Cleaning: {changed}')
+    redo_pts = FILENAMES[0] in changed
 
     # split
-    split_ehr_dataset(path, valid_pct, test_pct)
-
-    # clean + preprocess
-    all_splits = []
-    for split in ['train', 'valid', 'test']:
-        split_path = f'{path}/raw_split/{split}'
+    split_ehr_dataset(path, valid_pct, test_pct, chunksize=chunksize, by_hash=split_by_hash, names=changed)
+    splits = ['train', 'valid', 'test']
+    own_executor = not isinstance(executor, TaskExecutor)
+    executor = get_executor(executor)
+
+    try:
+        # clean - each task reads its own raw table
+        cleaned = [cleanup_dataset(f'{path}/raw_split/{split}', split == 'train', today, executor, changed) for split in splits]
+        code_tables = cleaned[0][1] if redo_pts else [None] + cleaned[0][1][1:]
+
+        # preprocess - insert age & extract labels
+        all_splits = [preprocess_dataset(data_tables, conditions_dict, executor) for data_tables, _ in cleaned]
+        if not redo_pts:
+            for data_tables in all_splits: data_tables[1] = None # demographics unchanged
+
+        # persist
+        saved = (persist_cleaned(path, 'train', all_splits[0], code_tables, executor) +
+                 persist_cleaned(path, 'valid', all_splits[1], executor=executor) +
+                 persist_cleaned(path, 'test',  all_splits[2], executor=executor))
+
+        # the whole graph is submitted - wait for it, keeping refs only until they're ready
+        stages = {'clean': [ref for data_tables, _ in cleaned for ref in data_tables] + code_tables,
+                  'preprocess': [ref for data_tables in all_splits for ref in data_tables],
+                  'persist': saved}
+        del cleaned, code_tables, all_splits
+        peaks = wait_stages(stages, executor)
+        executor.get(saved) # raises if any task failed
+    finally:
+        if own_executor: executor.shutdown()
+    for split in splits: print(f'Saved cleaned "{split}" data to {Path(f"{path}/cleaned/{split}")}')
+
+    with open(f'{path}/cleaned/fingerprints.json', 'w') as f: json.dump(fingerprints, f, indent=1)
+    return peaks
 
-        if split == 'train': data_tables, code_tables = clean_preprocess_dataset.remote(split_path, True,  conditions_dict, today)
-        else               : data_tables, _           = clean_preprocess_dataset.remote(split_path, False, conditions_dict, today)
+# Cell
+def load_cleaned_ehrdata(path, rec_columns=None):
+    '''Load cleaned, age-filtered EHR data - only `rec_columns` of the record tables (all tables after patient_demographics) if given'''
 
-        all_splits.append(data_tables)
+    csv_names = FILENAMES.copy()
+    csv_names.insert(1,'patient_demographics')
+    columns = [None, None] + [rec_columns]*(len(csv_names)-2)
 
-    # persist
-    remaining = []
-    remaining.append(persist_cleaned.remote(path, 'train', all_splits[0], code_tables))
-    remaining.append(persist_cleaned.remote(path, 'valid', all_splits[1]))
-    remaining.append(persist_cleaned.remote(path, 'test',  all_splits[2]))
+    train_dfs = [load_table(f'{path}/cleaned/train', fname, cols, index_col=0) for fname, cols in zip(csv_names, columns)]
+    valid_dfs = [load_table(f'{path}/cleaned/valid', fname, cols, index_col=0) for fname, cols in zip(csv_names, columns)]
+    test_dfs  = [load_table(f'{path}/cleaned/test',  fname, cols, index_col=0) for fname, cols in zip(csv_names, columns)]
 
-    while len(remaining) > 0:
-        ready, remaining = ray.wait(remaining)
-        for r in ready:
-            split_completed = ray.get(r)
-            print(f'Completed - {split_completed}')
-    return
+    return train_dfs, valid_dfs, test_dfs
 
 # Cell
-def load_cleaned_ehrdata(path):
-    '''Load cleaned, age-filtered EHR data'''
-
+def convert_csv_store(path, fmt='parquet', delete_csv=False):
+    '''Convert existing `raw_split` and `cleaned` csv tables under `path` to `fmt` (e.g. 'parquet') - dates get parsed and record codes category-encoded'''
     csv_names = FILENAMES.copy()
     csv_names.insert(1,'patient_demographics')
+    date_cols = ['date', 'start', 'stop', 'birthdate', 'deathdate']
 
-    train_dfs = [pd.read_csv(f'{path}/cleaned/train/{fname}.csv', low_memory=False, index_col=0) for fname in csv_names]
-    valid_dfs = [pd.read_csv(f'{path}/cleaned/valid/{fname}.csv', low_memory=False, index_col=0) for fname in csv_names]
-    test_dfs  = [pd.read_csv(f'{path}/cleaned/test/{fname}.csv', low_memory=False, index_col=0) for fname in csv_names]
-
-    return train_dfs, valid_dfs, test_dfs
+    for split in ['train', 'valid', 'test']:
+        for name in FILENAMES:
+            fpath = table_path(f'{path}/raw_split/{split}', name, 'csv')
+            if not fpath.exists(): continue
+            df = load_table(fpath.parent, name, fmt='csv')
+            save_table(df, fpath.parent, name, fmt, index=False, categorical=())
+            if delete_csv: fpath.unlink()
+
+        for name in csv_names:
+            fpath = table_path(f'{path}/cleaned/{split}', name, 'csv')
+            if not fpath.exists(): continue
+            df = load_table(fpath.parent, name, fmt='csv', index_col=0)
+            for col in date_cols:
+                if col in df.columns: df[col] = pd.to_datetime(df[col])
+            save_table(df, fpath.parent, name, fmt, index_label=df.index.name,
+                       categorical=('code',) if name not in ['patients','patient_demographics'] else ())
+            if delete_csv: fpath.unlink()
+
+    for name in FILENAMES:
+        fpath = table_path(f'{path}/cleaned/train/codes', f'code_{name}', 'csv')
+        if not fpath.exists(): continue
+        df = load_table(fpath.parent, fpath.stem, fmt='csv', na_filter=False, index_col=0)
+        save_table(df, fpath.parent, fpath.stem, fmt, index_label='indx', categorical=())
+        if delete_csv: fpath.unlink()
+
+    print(f'Converted csv tables in {path} to {fmt}')
 
 # Cell
 def load_ehr_vocabcodes(path):
     '''Load codes for vocabs'''
 
-    code_dfs = [pd.read_csv(f'{path}/cleaned/train/codes/code_{fname}.csv', low_memory=False, na_filter=False, index_col=0) for fname in FILENAMES]
+    code_dfs = [load_table(f'{path}/cleaned/train/codes', f'code_{fname}', na_filter=False, index_col=0) for fname in FILENAMES]
+    code_dfs = [df.fillna({col:'' for col in df.select_dtypes('object').columns}) for df in code_dfs] # as `na_filter=False` for csv
 
     return code_dfs
 
@@ -389,7 +729,7 @@ def test_extract_ys(pt_dfs, cnd_dfs, conditions_dict=CONDITIONS):
         print(f"Checking {split} dfs...")
         for this_cnd in conditions_dict.keys():
             code = f"{conditions_dict[this_cnd]}||START"
-            cnds_df_counts = len(cnds_df[cnds_df['code'] == code])
+            cnds_df_counts = cnds_df[cnds_df['code'] == code].index.nunique()
             pts_df_counts = len(pts_df[pts_df[this_cnd] == 1])
             assert cnds_df_counts == pts_df_counts, f"Error in {split} for {this_cnd} -- {cnds_df_counts} != {pts_df_counts}"
 
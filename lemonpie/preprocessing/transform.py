@@ -1,7 +1,11 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_preprocessing_transform.ipynb (unless otherwise specified).
 
-__all__ = ['collate_codes_offsts', 'get_codenums_offsts', 'get_demographics', 'Patient', 'get_pckl_dir', 'PatientList',
-           'cpu_cnt', 'create_all_ptlists', 'preprocess_ehr_dataset']
+__all__ = ['collate_codes_offsts', 'collate_all_codes_offsts', 'slice_rows', 'PatientIndex', 'patient_hashes',
+           'get_codenums_offsts', 'get_all_codenums_arrays', 'get_pt_codenums_offsts', 'get_all_codenums_offsts',
+           'get_demographics', 'get_age_span', 'Patient', 'REC_NAMES', 'PatientBatch', 'collate_patients',
+           'get_pckl_dir', 'ColumnarPatients', 'SharedRecords', 'load_ptlist_items', 'ptlist_manifest',
+           'save_ptlist_manifest', 'SegmentedPatients', 'balanced_chunks', 'PatientList', 'cpu_cnt',
+           'delete_ptlist_files', 'compact_ptlist', 'create_all_ptlists', 'preprocess_ehr_dataset']
 
 # Cell
 from ..basics import *
@@ -9,6 +13,10 @@ from .clean import *
 from .vocab import *
 from fastai.imports import *
 import torch.multiprocessing as multiprocessing
+import contextlib
+import copy
+import tempfile
+import time
 
 # Cell
 def collate_codes_offsts(rec_df, age_start, age_stop, age_in_months=False):
@@ -33,26 +41,219 @@ def collate_codes_offsts(rec_df, age_start, age_stop, age_in_months=False):
     assert len(offsts) == age_span
     return codes, offsts
 
+# Cell
+def collate_all_codes_offsts(rec_df, ptids, age_starts, age_span, age_in_months=False, pt_slices=None, none_code="xxnone"):
+    """Return EmbeddingBag lookup codes and offsets for all patients in `ptids` in a single pass over `rec_df`.
+    Same results as calling `collate_codes_offsts` for each patient, but flattened - patient `i`'s codes are
+    `codes[bounds[i]:bounds[i+1]]` and its offsets are `offsts[i]`.
+    If `pt_slices` (the `(starts, stops)` of each patient's rows, see `PatientIndex`) is passed, `rec_df` is sorted by patient
+    and the patients' rows are sliced out of it instead of looked up.
+    If the codes in `rec_df` are already numericalized, pass the number of `xxnone` as `none_code`."""
+    n_pts = len(ptids)
+    age_starts = np.broadcast_to(np.asarray(age_starts), (n_pts,))
+    if rec_df.empty:
+        pt_pos, ages, rec_codes = np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=object)
+    elif pt_slices is not None:
+        starts, stops = pt_slices
+        pt_rows = slice_rows(starts, stops)
+        pt_pos = np.repeat(np.arange(n_pts), stops - starts)
+        ages = (rec_df.age_months if age_in_months else rec_df.age).values[pt_rows]
+        rec_codes = rec_df.code.values[pt_rows]
+    else:
+        pt_pos = pd.Index(ptids).get_indexer(rec_df.index)
+        ages = (rec_df.age_months if age_in_months else rec_df.age).values
+        rec_codes = rec_df.code.values
+
+    # keep this table's rows for these patients & age span, sorted by (patient, age) - stable so record order is kept
+    rows = np.flatnonzero(pt_pos >= 0)
+    rel_age = ages[rows] - age_starts[pt_pos[rows]]
+    in_span = (rel_age >= 0) & (rel_age < age_span)
+    rows = rows[in_span]
+    bucket = pt_pos[rows] * age_span + rel_age[in_span].astype(np.int64)
+    order = np.argsort(bucket, kind="stable")
+    rows, bucket = rows[order], bucket[order]
+
+    # every (patient, age) bucket holds its codes, or a single 'xxnone' if nothing was recorded
+    counts = np.bincount(bucket, minlength=n_pts * age_span)
+    lens = np.maximum(counts, 1)
+    ends = np.cumsum(lens)
+    codes = np.full(ends[-1] if len(ends) else 0, none_code, dtype=object if isinstance(none_code, str) else np.int64)
+    rank = np.arange(len(bucket)) - (np.cumsum(counts) - counts)[bucket]
+    codes[(ends - lens)[bucket] + rank] = rec_codes[rows]
+
+    lens = lens.reshape(n_pts, age_span)
+    offsts = np.cumsum(lens, axis=1) - lens
+    bounds = np.concatenate(([0], ends[age_span - 1 :: age_span]))
+    return codes, offsts, bounds
+
+# Cell
+def slice_rows(starts, stops):
+    """Positions of the rows in ranges `starts[i]:stops[i]`, in order - a `slice` (so no copy) if the ranges are contiguous"""
+    if len(starts) == 0: return slice(0, 0)
+    if (starts[1:] == stops[:-1]).all(): return slice(starts[0], stops[-1])
+    lens = stops - starts
+    return np.repeat(starts - (np.cumsum(lens) - lens), lens) + np.arange(lens.sum())
+
+
+class PatientIndex:
+    """Where each patient's records are in the record tables once they are sorted by patient - patient `i`'s rows of
+    record table `r` are `starts[r][i]:stops[r][i]`. Built once per split and saved next to the cleaned data (see `for_split`)."""
+
+    fname = "patient_index.npz"
+
+    def __init__(self, ptids, orders, starts, stops, sources=None):
+        self.ptids, self.orders, self.starts, self.stops = ptids, orders, starts, stops
+        self.sources = sources
+
+    @classmethod
+    def create(cls, ptids, rec_dfs, sources=None):
+        """Create the index for (unique) patients `ptids` from record tables indexed by patient"""
+        ptids = np.asarray(ptids)
+        pt_idx = pd.Index(ptids)
+        orders, starts, stops = [], [], []
+        for rec_df in rec_dfs:
+            pos = pt_idx.get_indexer(rec_df.index)
+            rows = np.flatnonzero(pos >= 0)
+            orders.append(rows[np.argsort(pos[rows], kind="stable")])  # stable, so record order is kept
+            counts = np.bincount(pos[rows], minlength=len(ptids))
+            stops.append(np.cumsum(counts))
+            starts.append(stops[-1] - counts)
+        return cls(ptids, orders, starts, stops, sources)
+
+    def sort_tables(self, rec_dfs):
+        """Record tables sorted by patient (& only this index's patients) - the tables `starts` and `stops` point into"""
+        return [
+            rec_df if np.array_equal(order, np.arange(len(rec_df))) else rec_df.iloc[order]
+            for rec_df, order in zip(rec_dfs, self.orders)
+        ]
+
+    def slices(self, ptids):
+        """`(starts, stops)` of patients `ptids` for each record table"""
+        pos = pd.Index(self.ptids).get_indexer(ptids)
+        if (pos < 0).any():
+            raise Exception(f"{(pos < 0).sum()} patients are not in the patient index")
+        return [(starts[pos], stops[pos]) for starts, stops in zip(self.starts, self.stops)]
+
+    def take(self, ptids, rec_dfs):
+        """Index & record tables of just the patients `ptids`, from record tables sorted by this index"""
+        ptids = np.asarray(ptids)
+        orders, starts, stops, pt_dfs = [], [], [], []
+        for rec_df, (pt_starts, pt_stops) in zip(rec_dfs, self.slices(ptids)):
+            lens = pt_stops - pt_starts
+            stops.append(np.cumsum(lens))
+            starts.append(stops[-1] - lens)
+            orders.append(np.arange(lens.sum()))
+            pt_dfs.append(rec_df.iloc[orders[-1] + np.repeat(pt_starts - starts[-1], lens)])
+        return type(self)(ptids, orders, starts, stops, self.sources), pt_dfs
+
+    def save(self, dir):
+        """Save the index as `fname` in `dir`"""
+        arrays = {"ptids": self.ptids.astype(str), "sources": np.array(json.dumps(self.sources))}
+        for r, (order, starts, stops) in enumerate(zip(self.orders, self.starts, self.stops)):
+            arrays.update({f"order_{r}": order, f"starts_{r}": starts, f"stops_{r}": stops})
+        np.savez(f"{dir}/{self.fname}", **arrays)
+
+    @classmethod
+    def load(cls, dir):
+        """Load an index previously saved in `dir`"""
+        with np.load(f"{dir}/{cls.fname}") as arrays:
+            n_recs = len([key for key in arrays.files if key.startswith("order_")])
+            get = lambda part: [arrays[f"{part}_{r}"] for r in range(n_recs)]
+            return cls(arrays["ptids"].astype(object), get("order"), get("starts"), get("stops"), json.loads(str(arrays["sources"])))
+
+    @staticmethod
+    def table_stats(split_dir):
+        """Size & modification time of each cleaned table in `split_dir` - an index is stale if these changed"""
+        names = FILENAMES.copy()
+        names.insert(1, "patient_demographics")
+        stats = {}
+        for name in names:
+            fstat = find_table(split_dir, name).stat()
+            stats[name] = [fstat.st_size, fstat.st_mtime_ns]
+        return stats
+
+    @classmethod
+    def for_split(cls, path, split, all_dfs):
+        """Load the index saved with cleaned split `split` of dataset `path` - or create & save it, if there is none or
+        the cleaned tables (`all_dfs`, as loaded by `load_cleaned_ehrdata`) changed since"""
+        split_dir = Path(f"{path}/cleaned/{split}")
+        sources = cls.table_stats(split_dir)
+        if (split_dir / cls.fname).exists():
+            pt_index = cls.load(split_dir)
+            if pt_index.sources == sources:
+                return pt_index
+        pt_index = cls.create(all_dfs[0]["patient"].values, all_dfs[2:], sources)
+        pt_index.save(split_dir)
+        return pt_index
+
+
+def patient_hashes(all_dfs, pt_index):
+    """Content hash of each patient in `all_dfs[0]` - of its row there, its demographics and its records (in the record tables
+    of `all_dfs`, sorted by `pt_index`), so it changes if any of the patient's cleaned data does"""
+    ptids = all_dfs[0]["patient"].values
+    pt_hashes = [
+        pd.util.hash_pandas_object(all_dfs[0], index=False).values,
+        pd.util.hash_pandas_object(all_dfs[1].reindex(ptids), index=False).values,
+    ]
+    for rec_df, all_starts, all_stops, (starts, stops) in zip(
+        all_dfs[2:], pt_index.starts, pt_index.stops, pt_index.slices(ptids)
+    ):
+        # hash each record with its position among the patient's records, then sum them up per patient
+        lens = all_stops - all_starts
+        rank = np.arange(lens.sum()) - np.repeat(all_starts, lens)
+        rec_hashes = pd.util.hash_pandas_object(rec_df[["code", "age", "age_months"]], index=False).values
+        rec_hashes = pd.util.hash_array(rec_hashes ^ rank.astype(np.uint64))
+        cum_hashes = np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(rec_hashes, dtype=np.uint64)))
+        pt_hashes.append(cum_hashes[stops] - cum_hashes[starts])
+    return pd.util.hash_pandas_object(pd.DataFrame(np.stack(pt_hashes, axis=1)), index=False).values
+
 # Cell
 def get_codenums_offsts(rec_dfs, all_vocabs, age_start, age_stop, age_in_months):
     '''Get numericalized record codes and offsets for a patient for a given age span'''
     all_codes_offsts = [collate_codes_offsts(df, age_start, age_stop, age_in_months) for df in rec_dfs]
     obs_vocab, alg_vocab, crpl_vocab, med_vocab, img_vocab, proc_vocab, cnd_vocab, imm_vocab = all_vocabs
 
-    obs_c,  obs_o  = obs_vocab.numericalize (all_codes_offsts[0][0]), all_codes_offsts[0][1]
-    alg_c,  alg_o  = alg_vocab.numericalize (all_codes_offsts[1][0]), all_codes_offsts[1][1]
-    crpl_c, crpl_o = crpl_vocab.numericalize(all_codes_offsts[2][0]), all_codes_offsts[2][1]
-    med_c,  med_o  = med_vocab.numericalize (all_codes_offsts[3][0]), all_codes_offsts[3][1]
-    img_c,  img_o  = img_vocab.numericalize (all_codes_offsts[4][0]), all_codes_offsts[4][1]
-    proc_c, proc_o = proc_vocab.numericalize(all_codes_offsts[5][0]), all_codes_offsts[5][1]
-    cnd_c,  cnd_o  = cnd_vocab.numericalize (all_codes_offsts[6][0]), all_codes_offsts[6][1]
-    imm_c,  imm_o  = imm_vocab.numericalize (all_codes_offsts[7][0]), all_codes_offsts[7][1]
+    obs_c,  obs_o  = obs_vocab.numericalize_array (all_codes_offsts[0][0]), all_codes_offsts[0][1]
+    alg_c,  alg_o  = alg_vocab.numericalize_array (all_codes_offsts[1][0]), all_codes_offsts[1][1]
+    crpl_c, crpl_o = crpl_vocab.numericalize_array(all_codes_offsts[2][0]), all_codes_offsts[2][1]
+    med_c,  med_o  = med_vocab.numericalize_array (all_codes_offsts[3][0]), all_codes_offsts[3][1]
+    img_c,  img_o  = img_vocab.numericalize_array (all_codes_offsts[4][0]), all_codes_offsts[4][1]
+    proc_c, proc_o = proc_vocab.numericalize_array(all_codes_offsts[5][0]), all_codes_offsts[5][1]
+    cnd_c,  cnd_o  = cnd_vocab.numericalize_array (all_codes_offsts[6][0]), all_codes_offsts[6][1]
+    imm_c,  imm_o  = imm_vocab.numericalize_array (all_codes_offsts[7][0]), all_codes_offsts[7][1]
 
     all_codenums = [obs_c,alg_c,crpl_c,med_c,img_c,proc_c,cnd_c,imm_c]
     all_offsts   = [obs_o,alg_o,crpl_o,med_o,img_o,proc_o,cnd_o,imm_o]
 
     return all_codenums, all_offsts
 
+# Cell
+def get_all_codenums_arrays(all_rec_dfs, all_vocabs, ptids, age_starts, age_span, age_in_months, all_pt_slices=None, numericalized=False):
+    '''Get numericalized record codes (flattened), offsets and bounds for all patients in `ptids` - one tuple per record type.
+    Pass `all_pt_slices` (from `PatientIndex.slices`) if the record tables are sorted by patient, and `numericalized` if their
+    codes are already numericalized (see `SharedRecords`)'''
+    all_arrays = []
+    if all_pt_slices is None: all_pt_slices = [None] * len(all_rec_dfs)
+    for rec_df, vocab, pt_slices in zip(all_rec_dfs, all_vocabs, all_pt_slices):
+        if numericalized:
+            none_num = int(vocab.numericalize_array(["xxnone"], log_excep=False)[0])
+            all_arrays.append(collate_all_codes_offsts(rec_df, ptids, age_starts, age_span, age_in_months, pt_slices, none_num))
+            continue
+        codes, offsts, bounds = collate_all_codes_offsts(rec_df, ptids, age_starts, age_span, age_in_months, pt_slices)
+        all_arrays.append((vocab.numericalize_array(codes), offsts, bounds))
+    return all_arrays
+
+def get_pt_codenums_offsts(all_arrays, i):
+    '''Get patient `i`'s numericalized record codes and offsets (same as `get_codenums_offsts`) from `get_all_codenums_arrays` results'''
+    all_codenums = [codenums[bounds[i]:bounds[i+1]].astype(np.int64) for codenums, _, bounds in all_arrays]
+    all_offsts   = [offsts[i].tolist() for _, offsts, _ in all_arrays]
+    return all_codenums, all_offsts
+
+def get_all_codenums_offsts(all_rec_dfs, all_vocabs, ptids, age_starts, age_span, age_in_months):
+    '''Get numericalized record codes and offsets for all patients in `ptids`, one `get_codenums_offsts` result per patient'''
+    all_arrays = get_all_codenums_arrays(all_rec_dfs, all_vocabs, ptids, age_starts, age_span, age_in_months)
+    return [get_pt_codenums_offsts(all_arrays, i) for i in range(len(ptids))]
+
 # Cell
 def get_demographics(demograph_vector, demographics_vocabs, age_mean, age_std):
     '''Numericalize demographics and normalize age for a given patient'''
@@ -62,25 +263,45 @@ def get_demographics(demograph_vector, demographics_vocabs, age_mean, age_std):
 
     birthdate = pd.Timestamp(demograph_vector[0])
 
-    demographics.extend(bday.numericalize      ([birthdate.day]))
-    demographics.extend(bmonth.numericalize    ([birthdate.month]))
-    demographics.extend(byear.numericalize     ([birthdate.year]))
-    demographics.extend(marital.numericalize   ([demograph_vector[1]]))
-    demographics.extend(race.numericalize      ([demograph_vector[2]]))
-    demographics.extend(ethnicity.numericalize ([demograph_vector[3]]))
-    demographics.extend(gender.numericalize    ([demograph_vector[4]]))
-    demographics.extend(birthplace.numericalize([demograph_vector[5]]))
-    demographics.extend(city.numericalize      ([demograph_vector[6]]))
-    demographics.extend(state.numericalize     ([demograph_vector[7]]))
-    demographics.extend(zipcode.numericalize   ([demograph_vector[8]]))
+    demographics.extend(bday.numericalize_array      ([birthdate.day]))
+    demographics.extend(bmonth.numericalize_array    ([birthdate.month]))
+    demographics.extend(byear.numericalize_array     ([birthdate.year]))
+    demographics.extend(marital.numericalize_array   ([demograph_vector[1]]))
+    demographics.extend(race.numericalize_array      ([demograph_vector[2]]))
+    demographics.extend(ethnicity.numericalize_array ([demograph_vector[3]]))
+    demographics.extend(gender.numericalize_array    ([demograph_vector[4]]))
+    demographics.extend(birthplace.numericalize_array([demograph_vector[5]]))
+    demographics.extend(city.numericalize_array      ([demograph_vector[6]]))
+    demographics.extend(state.numericalize_array     ([demograph_vector[7]]))
+    demographics.extend(zipcode.numericalize_array   ([demograph_vector[8]]))
     age = (demograph_vector[9] - age_mean) / age_std
 
     return demographics, age
 
 # Cell
+def get_age_span(age_start, age_range, birthdate, start_is_date, age_in_months):
+    """Return a patient's age start and stop (in years or months) - if `start_is_date`, `age_start` is converted using the birthdate"""
+    if start_is_date:
+        age_start, birthdate = pd.to_datetime(age_start), pd.to_datetime(birthdate)
+        if age_in_months:
+            age_start = (age_start - birthdate) // np.timedelta64(1, "M")
+        else:
+            age_start = (age_start - birthdate) // np.timedelta64(1, "Y")
+    age_stop = age_start + age_range
+    return age_start, age_stop, birthdate
+
+# Cell
+REC_NAMES = ["obs", "alg", "crpl", "med", "img", "proc", "cnd", "imm"]
+
+
 class Patient:
     """Class defining a patient object that holds all numericalized / transformed data for a single patient"""
 
+    tensor_attrs = [f"{rec}_{part}" for part in ["nums", "offsts"] for rec in REC_NAMES] + [
+        "demographics",
+        "age_now",
+    ]
+
     def __init__(
         self, nums, offsts, demographics, age_now, birthdate, conditions, ptid
     ):
@@ -126,20 +347,21 @@ class Patient:
         age_range,
         start_is_date,
         age_in_months,
+        codenums_offsts=None,
     ):
-        """Lookup codes, numericalize and then create patient object - given a patient id"""
+        """Lookup codes, numericalize and then create patient object - given a patient id.
+        Pass `codenums_offsts` if the codes were already numericalized for many patients by `get_all_codenums_offsts`"""
 
-        if start_is_date:
-            age_start, birthdate = pd.to_datetime(age_start), pd.to_datetime(birthdate)
-            if age_in_months:
-                age_start = (age_start - birthdate) // np.timedelta64(1, "M")
-            else:
-                age_start = (age_start - birthdate) // np.timedelta64(1, "Y")
-        age_stop = age_start + age_range
-
-        codenums, offsts = get_codenums_offsts(
-            rec_dfs, vocablist.records_vocabs, age_start, age_stop, age_in_months
+        age_start, age_stop, birthdate = get_age_span(
+            age_start, age_range, birthdate, start_is_date, age_in_months
         )
+
+        if codenums_offsts is None:
+            codenums, offsts = get_codenums_offsts(
+                rec_dfs, vocablist.records_vocabs, age_start, age_stop, age_in_months
+            )
+        else:
+            codenums, offsts = codenums_offsts
         demographics, age_now = get_demographics(
             demograph,
             vocablist.demographics_vocabs,
@@ -149,34 +371,26 @@ class Patient:
 
         return cls(codenums, offsts, demographics, age_now, birthdate, conditions, ptid)
 
+    def _apply(self, fn):
+        """Return a shallow copy of this patient object with `fn` applied to all its tensors - this object is not modified"""
+        pt = copy.copy(self)
+        for attr in self.tensor_attrs:
+            setattr(pt, attr, fn(getattr(self, attr)))
+        return pt
+
     def pin_memory(self):
-        """Call `torch.Tensor.pin_memory` for (all tensors of) this patient object"""
-        if not self.obs_nums.is_pinned():
-            self.obs_nums = self.obs_nums.pin_memory()
-            self.alg_nums = self.alg_nums.pin_memory()
-            self.crpl_nums = self.crpl_nums.pin_memory()
-            self.med_nums = self.med_nums.pin_memory()
-            self.img_nums = self.img_nums.pin_memory()
-            self.proc_nums = self.proc_nums.pin_memory()
-            self.cnd_nums = self.cnd_nums.pin_memory()
-            self.imm_nums = self.imm_nums.pin_memory()
-
-            self.obs_offsts = self.obs_offsts.pin_memory()
-            self.alg_offsts = self.alg_offsts.pin_memory()
-            self.crpl_offsts = self.crpl_offsts.pin_memory()
-            self.med_offsts = self.med_offsts.pin_memory()
-            self.img_offsts = self.img_offsts.pin_memory()
-            self.proc_offsts = self.proc_offsts.pin_memory()
-            self.cnd_offsts = self.cnd_offsts.pin_memory()
-            self.imm_offsts = self.imm_offsts.pin_memory()
-
-            self.demographics = self.demographics.pin_memory()
-            self.age_now = self.age_now.pin_memory()
+        """Call `torch.Tensor.pin_memory` for (all tensors of) this patient object - returns a pinned copy, this object is not modified"""
+        if self.obs_nums.is_pinned():
+            return self
+        return self._apply(lambda t: t.pin_memory())
 
-        return self
+    def to(self, device, non_block=False):
+        """Return a copy of this patient object with all tensors on `device` - this object is not modified,
+        so patients held by a dataset can be handed out and transferred without copying them first"""
+        return self._apply(lambda t: t.to(device, non_blocking=non_block))
 
     def to_gpu(self, non_block=False):
-        """Puts (all tensors of) this patient object on GPU"""
+        """Puts (all tensors of) this patient object on GPU - in place, use `Patient.to` to get a copy instead"""
         self.obs_nums = self.obs_nums.to(DEVICE, non_blocking=non_block)
         self.alg_nums = self.alg_nums.to(DEVICE, non_blocking=non_block)
         self.crpl_nums = self.crpl_nums.to(DEVICE, non_blocking=non_block)
@@ -201,6 +415,59 @@ class Patient:
         return self
 
 
+# Cell
+class PatientBatch:
+    """Class holding a batch of patients as a few tensors - `nums` & `offsets` (one flat tensor per record type),
+    `demographics` `(bs, n)` and `age_now` `(bs, 1)` - so the whole batch is pinned / moved to GPU in a handful of copies"""
+
+    def __init__(self, nums, offsets, demographics, age_now):
+        self.nums, self.offsets = nums, offsets
+        self.demographics, self.age_now = demographics, age_now
+
+    def __len__(self):
+        return len(self.demographics)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__} ({len(self)} patients, bptt:{self.bptt}), device:{self.demographics.device}"
+
+    @property
+    def bptt(self):
+        """Number of offsets (age span) per patient"""
+        return len(self.offsets[0]) // len(self)
+
+    def _apply(self, fn):
+        """Return a new `PatientBatch` with `fn` applied to all tensors"""
+        return self.__class__(
+            [fn(t) for t in self.nums],
+            [fn(t) for t in self.offsets],
+            fn(self.demographics),
+            fn(self.age_now),
+        )
+
+    def pin_memory(self):
+        """Call `torch.Tensor.pin_memory` for all tensors of this batch - called by `DataLoader(pin_memory=True)`"""
+        return self._apply(lambda t: t.pin_memory())
+
+    def to(self, device, non_block=False):
+        """Return this batch with all tensors on `device`"""
+        return self._apply(lambda t: t.to(device, non_blocking=non_block))
+
+
+def collate_patients(pts):
+    """Concatenate the tensors of a batch of `Patient`s into a `PatientBatch` - one flat codes tensor per record type
+    with offsets shifted by a running base, so each `EmbeddingBag` runs once per batch"""
+    all_nums, all_offsts = [], []
+    for rec in REC_NAMES:
+        nums = [getattr(pt, f"{rec}_nums") for pt in pts]
+        bases = np.cumsum([0] + [len(rec_nums) for rec_nums in nums[:-1]])
+        offsts = torch.stack([getattr(pt, f"{rec}_offsts") for pt in pts])
+        all_nums.append(torch.cat(nums))
+        all_offsts.append((offsts + torch.tensor(bases, device=offsts.device)[:, None]).flatten())
+    demographics = torch.stack([pt.demographics for pt in pts])
+    age_now = torch.stack([pt.age_now for pt in pts])
+    return PatientBatch(all_nums, all_offsts, demographics, age_now)
+
+
 # Cell
 def get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months):
     """Util function to construct pickle dir name - for persisting transformed `PatientList`s"""
@@ -213,6 +480,237 @@ def get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months
     return pckl_dir
 
 
+# Cell
+class ColumnarPatients:
+    """Read-only sequence of `Patient` objects backed by memory-mapped `.npy` arrays - the columnar `PatientList` format.
+    `Patient`s are created on access, so loading is near-instant and DataLoader workers share the same pages."""
+
+    meta_fname = "ptlist_meta.pkl"
+
+    def __init__(self, pckl_dir, mmap_mode="r"):
+        self.pckl_dir, self.mmap_mode = pckl_dir, mmap_mode
+        with open(f"{pckl_dir}/{self.meta_fname}", "rb") as meta_f:
+            meta = pickle.load(meta_f)
+        self.ptids, self.birthdates, self.label_names = meta["ptids"], meta["birthdates"], meta["label_names"]
+
+        load = lambda name: np.load(f"{pckl_dir}/{name}.npy", mmap_mode=mmap_mode)
+        self.recs = [
+            (load(f"{rec}_nums"), load(f"{rec}_offsts"), load(f"{rec}_bounds"))
+            for rec in REC_NAMES
+        ]
+        self.demographics, self.age_now, self.labels = load("demographics"), load("age_now"), load("labels")
+
+    def __getstate__(self):
+        """Only pickle the location, so that DataLoader workers re-open the memory maps instead of copying arrays"""
+        return {"pckl_dir": self.pckl_dir, "mmap_mode": self.mmap_mode}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self.ptids)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        codenums, offsts = get_pt_codenums_offsts(self.recs, i)
+        conditions = dict(zip(self.label_names, self.labels[i]))
+        return Patient(
+            codenums,
+            offsts,
+            self.demographics[i].astype(np.int64),
+            self.age_now[i],
+            self.birthdates[i],
+            conditions,
+            self.ptids[i],
+        )
+
+    def label_values(self, labels):
+        """Values of `labels` for all patients, `(n_patients, len(labels))` - read from the labels array, without creating `Patient`s"""
+        return self.labels[:, [self.label_names.index(label) for label in labels]]
+
+    def chunk(self, idxs):
+        """Arrays of patients `idxs` in the form `save` takes - to copy them into another columnar list"""
+        idxs = np.asarray(idxs)
+        recs = []
+        for nums, offsts, bounds in self.recs:
+            starts, stops = bounds[idxs], bounds[idxs + 1]
+            recs.append((nums[slice_rows(starts, stops)], offsts[idxs], np.concatenate(([0], np.cumsum(stops - starts)))))
+        return {
+            "ptids": [self.ptids[i] for i in idxs],
+            "birthdates": [self.birthdates[i] for i in idxs],
+            "labels": self.labels[idxs],
+            "demographics": self.demographics[idxs],
+            "age_now": self.age_now[idxs],
+            "recs": recs,
+        }
+
+    @classmethod
+    def save(cls, chunks, pckl_dir, label_names):
+        """Concatenate transformed chunks of patients into one contiguous array per field and save them as `.npy` files"""
+        for r, rec in enumerate(REC_NAMES):
+            rec_chunks = [chunk["recs"][r] for chunk in chunks]
+            nums = np.concatenate([codenums for codenums, _, _ in rec_chunks])
+            offsts = np.concatenate([offsts for _, offsts, _ in rec_chunks])
+            sizes = np.concatenate([np.diff(bounds) for _, _, bounds in rec_chunks])
+            np.save(f"{pckl_dir}/{rec}_nums.npy", nums.astype(np.int32))
+            np.save(f"{pckl_dir}/{rec}_offsts.npy", offsts.astype(np.int32))
+            np.save(f"{pckl_dir}/{rec}_bounds.npy", np.concatenate(([0], np.cumsum(sizes))))
+
+        for field in ["demographics", "age_now", "labels"]:
+            np.save(f"{pckl_dir}/{field}.npy", np.concatenate([chunk[field] for chunk in chunks]))
+
+        meta = {
+            "ptids": [ptid for chunk in chunks for ptid in chunk["ptids"]],
+            "birthdates": [bday for chunk in chunks for bday in chunk["birthdates"]],
+            "label_names": label_names,
+        }
+        with open(f"{pckl_dir}/{cls.meta_fname}", "wb") as meta_f:  # written last, marks a complete save
+            pickle.dump(meta, meta_f)
+        return len(meta["ptids"])
+
+
+# Cell
+class SharedRecords:
+    """Record tables (sorted by patient) saved once as memory-mapped `.npy` arrays, for `PatientList.create_save` pool workers
+    to attach to read-only - codes numericalized, ages as is. Pickles as just its location, like `ColumnarPatients`."""
+
+    def __init__(self, dir, mmap_mode="r"):
+        self.dir, self.mmap_mode = dir, mmap_mode
+        load = lambda name: np.load(f"{dir}/{name}.npy", mmap_mode=mmap_mode)
+        self.recs = [(load(f"{rec}_nums"), load(f"{rec}_age"), load(f"{rec}_age_months")) for rec in REC_NAMES]
+
+    def __getstate__(self):
+        return {"dir": self.dir, "mmap_mode": self.mmap_mode}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @classmethod
+    def save(cls, rec_dfs, records_vocabs, dir):
+        """Save the `code`s (numericalized with `records_vocabs`), `age` & `age_months` columns of record tables `rec_dfs` in `dir` -
+        each code is numericalized once here, however many age windows are then created from it"""
+        for rec, rec_df, vocab in zip(REC_NAMES, rec_dfs, records_vocabs):
+            np.save(f"{dir}/{rec}_nums.npy", vocab.numericalize_array(rec_df["code"].values).astype(np.int32))
+            np.save(f"{dir}/{rec}_age.npy", rec_df["age"].values)
+            np.save(f"{dir}/{rec}_age_months.npy", rec_df["age_months"].values)
+        return cls(dir)
+
+    def chunk_tables(self, all_pt_slices):
+        """Records of a chunk of patients given their `(starts, stops)` - one small table per record type (with numericalized codes),
+        and the patients' `(starts, stops)` in those"""
+        tables, chunk_slices = [], []
+        for (nums, ages, age_months), (starts, stops) in zip(self.recs, all_pt_slices):
+            rows = slice_rows(starts, stops)
+            tables.append(pd.DataFrame({"code": nums[rows], "age": ages[rows], "age_months": age_months[rows]}))
+            ends = np.cumsum(stops - starts)
+            chunk_slices.append((ends - (stops - starts), ends))
+        return tables, chunk_slices
+
+
+# Cell
+def load_ptlist_items(pckl_dir):
+    """Patients saved in `pckl_dir` (not counting upsert segments) - a `ColumnarPatients` or a list of `Patient`s"""
+    if (Path(pckl_dir) / ColumnarPatients.meta_fname).exists():
+        return ColumnarPatients(pckl_dir)
+    ptlist = []
+    for file in Path(pckl_dir).glob("*.ptlist"):
+        with open(file, "rb") as infile:
+            ptlist.extend(pickle.load(infile))
+    return ptlist
+
+
+MANIFEST_FNAME, PT_HASHES_FNAME = "ptlist_manifest.json", "pt_hashes.npz"
+
+
+def ptlist_manifest(pckl_dir):
+    """Manifest of the upsert segments of the `PatientList` saved in `pckl_dir`, and the hashes (see `patient_hashes`)
+    of its patients - `(None, None, None)` if it has none"""
+    manifest_file = Path(pckl_dir) / MANIFEST_FNAME
+    if not manifest_file.exists():
+        return None, None, None
+    with open(manifest_file) as infile:
+        manifest = json.load(infile)
+    with np.load(Path(pckl_dir) / PT_HASHES_FNAME) as arrays:
+        return manifest, arrays["ptids"].astype(object), arrays["hashes"]
+
+
+def save_ptlist_manifest(pckl_dir, manifest, ptids, hashes):
+    """Save the manifest & patient hashes of the `PatientList` in `pckl_dir` - the manifest last, as it marks a complete update"""
+    np.savez(Path(pckl_dir) / PT_HASHES_FNAME, ptids=np.asarray(ptids).astype(str), hashes=hashes)
+    with open(Path(pckl_dir) / MANIFEST_FNAME, "w") as outfile:
+        json.dump(manifest, outfile)
+
+
+class SegmentedPatients:
+    """Read-only sequence of the patients of a `PatientList` saved as a base and upsert segments (see `PatientList.upsert_save`) -
+    a patient's latest version is used, and patients are dropped by the tombstones of the segment after which they were removed"""
+
+    def __init__(self, pckl_dir):
+        self.pckl_dir = pckl_dir
+        manifest, _, _ = ptlist_manifest(pckl_dir)
+        segments = manifest["segments"]
+        self.parts = [load_ptlist_items(pckl_dir)]
+        self.parts += [load_ptlist_items(Path(pckl_dir) / "segments" / seg["name"]) for seg in segments]
+
+        live = {}  # ptid -> (part, position in part), in order of first appearance
+        for p, (part, seg) in enumerate(zip(self.parts, [None] + segments)):
+            if seg is not None:
+                for ptid in seg["tombstones"]:
+                    live.pop(ptid, None)
+            part_ptids = part.ptids if isinstance(part, ColumnarPatients) else [pt.ptid for pt in part]
+            for i, ptid in enumerate(part_ptids):
+                live[ptid] = (p, i)
+        self.locs = np.array(list(live.values()), dtype=np.int64).reshape(-1, 2)
+
+    def __getstate__(self):
+        return {"pckl_dir": self.pckl_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self.locs)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        p, j = self.locs[i]
+        return self.parts[p][j]
+
+    def label_values(self, labels):
+        """Values of `labels` for all patients, `(n_patients, len(labels))` - from the labels arrays of columnar parts"""
+        values = np.empty((len(self), len(labels)))
+        for p, part in enumerate(self.parts):
+            in_part = self.locs[:, 0] == p
+            if isinstance(part, ColumnarPatients):
+                values[in_part] = part.label_values(labels)[self.locs[in_part, 1]]
+            else:
+                values[in_part] = [[part[j].conditions[label] for label in labels] for j in self.locs[in_part, 1]]
+        return values
+
+
+# Cell
+def balanced_chunks(sizes, n_chunks):
+    """Split positions `0..len(sizes)` into contiguous chunks of about the same total size, cut where the running total
+    crosses each `1/n_chunks` share - an item bigger than a share gets a chunk of its own, so there can be a few more than `n_chunks`"""
+    if len(sizes) == 0:
+        return []
+    ends = np.cumsum(sizes, dtype=np.float64)
+    targets = ends[-1] * np.arange(1, n_chunks) / n_chunks
+    big = np.flatnonzero(np.asarray(sizes) > ends[-1] / n_chunks)
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(ends, targets) + 1, big, big + 1, [len(sizes)])))
+    return [np.arange(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
 # Cell
 multiprocessing.set_sharing_strategy("file_system")
 cpu_cnt = int(multiprocessing.cpu_count())
@@ -266,52 +764,115 @@ class PatientList:
         start_is_date,
         age_in_months,
         verbose,
+        columnar=False,
+        pt_slices=None,
+        shared_recs=None,
+        windows=None,
     ):
-        """Parallelized function to run on one core and transform a single chunk of patients and save"""
-
-        pts = []
-        for indx in indx_chnk:
-            thispt = all_dfs[0].iloc[indx]
-            ptid, birthdate = thispt["patient"], thispt["birthdate"]
-
-            conditions = {}
-            for cnd in cnds:
-                conditions[cnd] = thispt[cnd]
-
-            rec_dfs = []
-            for rec_df in all_dfs[2:]:
-                try:
-                    rec_dfs.append(rec_df.loc[[ptid]])
-                except KeyError:
-                    rec_dfs.append(pd.DataFrame())
-
-            demograph = all_dfs[1].loc[ptid]
-
-            pts.append(
-                Patient.create(
-                    rec_dfs,
-                    demograph,
-                    vocablist,
-                    ptid,
-                    birthdate,
-                    conditions,
-                    age_start,
-                    age_range,
-                    start_is_date,
-                    age_in_months,
+        """Parallelized function to run on one core and transform a single chunk of patients and save.
+        If `columnar`, return the chunk's arrays instead - they are saved together by `ColumnarPatients.save`.
+        `pt_slices` are the `PatientIndex.slices` of all patients in `all_dfs[0]`, whose record tables are then sorted by patient.
+        If `shared_recs` (a `SharedRecords`) is passed, the record tables are read from it and `all_dfs` need only hold the first 2.
+        If `windows` (a list of `(pckl_dir, age_start, age_range, age_in_months)`) is passed, the chunk is transformed for each
+        of them instead of the single window in the arguments - reading its records only once - and a list of results is returned"""
+
+        chnk_pts = all_dfs[0].iloc[indx_chnk]
+        rec_dfs, chnk_slices = all_dfs[2:], None
+        if pt_slices is not None:
+            chnk_slices = [(starts[indx_chnk], stops[indx_chnk]) for starts, stops in pt_slices]
+        if shared_recs is not None:
+            rec_dfs, chnk_slices = shared_recs.chunk_tables(chnk_slices)
+        if columnar:
+            demographics = [
+                get_demographics(
+                    all_dfs[1].loc[ptid],
+                    vocablist.demographics_vocabs,
+                    vocablist.age_mean,
+                    vocablist.age_std,
                 )
+                for ptid in chnk_pts["patient"]
+            ]
+
+        results = []
+        for pckl_dir, age_start, age_range, age_in_months in windows or [(pckl_dir, age_start, age_range, age_in_months)]:
+            age_spans = [
+                get_age_span(age_start, age_range, bday, start_is_date, age_in_months)
+                for bday in chnk_pts["birthdate"]
+            ]
+            all_arrays = get_all_codenums_arrays(
+                rec_dfs,
+                vocablist.records_vocabs,
+                chnk_pts["patient"].values,
+                [span[0] for span in age_spans],
+                age_range,
+                age_in_months,
+                chnk_slices,
+                numericalized=shared_recs is not None,
             )
 
-        with open(
-            f"{pckl_dir}/patients_{indx_chnk[0]}_{indx_chnk[-1]}.ptlist", "wb"
-        ) as pckl_f:
-            pickle.dump(pts, pckl_f)
+            if columnar:
+                results.append({
+                    "ptids": chnk_pts["patient"].tolist(),
+                    "birthdates": [span[2] for span in age_spans],
+                    "labels": chnk_pts[cnds].values,
+                    "demographics": np.array([dem for dem, _ in demographics]),
+                    "age_now": np.array([age for _, age in demographics]),
+                    "recs": all_arrays,
+                })
+                continue
+
+            pts = []
+            for i, indx in enumerate(indx_chnk):
+                thispt = all_dfs[0].iloc[indx]
+                ptid, birthdate = thispt["patient"], thispt["birthdate"]
+
+                conditions = {}
+                for cnd in cnds:
+                    conditions[cnd] = thispt[cnd]
+
+                demograph = all_dfs[1].loc[ptid]
+
+                pts.append(
+                    Patient.create(
+                        None,
+                        demograph,
+                        vocablist,
+                        ptid,
+                        birthdate,
+                        conditions,
+                        age_start,
+                        age_range,
+                        start_is_date,
+                        age_in_months,
+                        get_pt_codenums_offsts(all_arrays, i),
+                    )
+                )
+
+            with open(
+                f"{pckl_dir}/patients_{indx_chnk[0]}_{indx_chnk[-1]}.ptlist", "wb"
+            ) as pckl_f:
+                pickle.dump(pts, pckl_f)
+            results.append(len(pts))
 
         if verbose:
             print(
                 f"{multiprocessing.current_process().name}-- completed {len(indx_chnk)} patients"
             )
-        return len(pts)
+        return results if windows is not None else results[0]
+
+    _worker_inputs = {}
+
+    def _init_worker(inputs):
+        """Pool worker initializer - keeps the inputs shared by all chunks, so tasks only carry their patient indices"""
+        PatientList._worker_inputs = inputs
+
+    def _create_worker_chunk(task):
+        """`_create_pts_chunk` with the inputs passed to `_init_worker` - for task `(chunk number, indx_chnk)`,
+        returns `(chunk number, result, seconds taken)`"""
+        chnk_num, indx_chnk = task
+        start = time.time()
+        res = PatientList._create_pts_chunk(indx_chnk, **PatientList._worker_inputs)
+        return chnk_num, res, time.time() - start
 
     @classmethod
     def create_save(
@@ -324,128 +885,313 @@ class PatientList:
         start_is_date,
         age_in_months,
         verbose=False,
+        columnar=False,
+        pt_index=None,
+        n_workers=None,
+        chunks_per_worker=4,
     ):
-        """Function to parellelize (based on available CPU cores) transformation for all patients in given dataset and save `PatientList` object"""
-        pckl_dir.mkdir(parents=True, exist_ok=True)
-        indx_chnks = []
+        """Function to parellelize (based on available CPU cores) transformation for all patients in given dataset and save `PatientList` object.
+        If `columnar`, save in the memory-mappable columnar format (see `ColumnarPatients`), else as pickled `Patient` objects.
+        Pass the split's `pt_index` if the record tables in `all_dfs` are already sorted by it, else one is created here.
+        The record tables are handed to the workers as `SharedRecords` and everything else once per worker - not with every chunk.
+        Patients are split into `chunks_per_worker` chunks of about the same number of records for each of the `n_workers`
+        processes (`PTLIST_WORKERS` setting, or all cores), biggest first - so workers pick up the next chunk as they finish"""
+        cls.create_save_windows(
+            all_dfs,
+            vocablist,
+            [(pckl_dir, age_start, age_range, age_in_months)],
+            start_is_date,
+            verbose,
+            columnar,
+            pt_index,
+            n_workers,
+            chunks_per_worker,
+        )
+
+    @classmethod
+    def create_save_windows(
+        cls,
+        all_dfs,
+        vocablist,
+        windows,
+        start_is_date,
+        verbose=False,
+        columnar=False,
+        pt_index=None,
+        n_workers=None,
+        chunks_per_worker=4,
+        shared_recs=None,
+    ):
+        """`create_save` for many age windows in one pass - `windows` is a list of `(pckl_dir, age_start, age_range, age_in_months)`.
+        The record tables are numericalized once and each chunk of patients is read once for all windows.
+        Pass `shared_recs` (`SharedRecords` of the record tables in `all_dfs`, sorted by `pt_index`) to reuse them across calls,
+        else they are saved in a temporary directory for this call"""
+        for pckl_dir, *_ in windows:
+            pckl_dir.mkdir(parents=True, exist_ok=True)
+        n_workers = n_workers or PTLIST_WORKERS or cpu_cnt
 
         patients_df = all_dfs[0]
+        if pt_index is None:
+            pt_index = PatientIndex.create(patients_df["patient"].values, all_dfs[2:])
+            all_dfs = all_dfs[:2] + pt_index.sort_tables(all_dfs[2:])
+        pt_slices = pt_index.slices(patients_df["patient"].values)
         cnds = []
         for col in patients_df.columns[2:]:
             if "_age" not in col:
                 cnds.append(col)
 
-        total_pts = len(patients_df)
-        all_indxs = np.arange(total_pts)
-        chnk_sz = max( (total_pts // (cpu_cnt - 1)), 1)
-
-        for i in range(0, total_pts, chnk_sz):
-            indx_chnks.append(list(all_indxs[i : i + chnk_sz]))
+        pt_recs = sum(stops - starts for starts, stops in pt_slices)  # each patient's number of records
+        indx_chnks = balanced_chunks(pt_recs + 1, n_workers * chunks_per_worker)
+        chnk_recs = [pt_recs[indx_chnk].sum() for indx_chnk in indx_chnks]
+        tasks = [(i, indx_chnks[i]) for i in np.argsort(chnk_recs, kind="stable")[::-1]]
+
+        with tempfile.TemporaryDirectory() if shared_recs is None else contextlib.nullcontext() as shared_dir:
+            if shared_recs is None:
+                shared_recs = SharedRecords.save(all_dfs[2:], vocablist.records_vocabs, shared_dir)
+            worker_inputs = dict(
+                all_dfs=all_dfs[:2],
+                vocablist=vocablist,
+                cnds=cnds,
+                pckl_dir=None,
+                age_start=None,
+                age_range=None,
+                start_is_date=start_is_date,
+                age_in_months=None,
+                verbose=verbose,
+                columnar=columnar,
+                pt_slices=pt_slices,
+                shared_recs=shared_recs,
+                windows=windows,
+            )
+            all_chunks = [None] * len(indx_chnks)
+            with multiprocessing.Pool(processes=n_workers, initializer=cls._init_worker, initargs=(worker_inputs,)) as pool:
+                for chnk_num, res, secs in pool.imap_unordered(cls._create_worker_chunk, tasks):
+                    all_chunks[chnk_num] = res
+                    if verbose:
+                        print(
+                            f"chunk {chnk_num}: {len(indx_chnks[chnk_num])} patients, {chnk_recs[chnk_num]} records in {secs:.2f}s "
+                            f"- {len(indx_chnks[chnk_num]) / secs:.1f} patients/s, {chnk_recs[chnk_num] / secs:.0f} records/s"
+                        )
+                pool.close()
+                pool.join()
+
+        for w, (pckl_dir, *_) in enumerate(windows):
+            if columnar:
+                total = ColumnarPatients.save([chunk[w] for chunk in all_chunks], pckl_dir, cnds)
+            else:
+                total = sum(chunk[w] for chunk in all_chunks)
+            print(
+                f"{total} total patients completed, saved patient list to {pckl_dir}"
+            )
 
-        pool = multiprocessing.Pool(processes=cpu_cnt)
-        parallelize = partial(
-            cls._create_pts_chunk,
-            all_dfs=all_dfs,
-            vocablist=vocablist,
-            cnds=cnds,
-            pckl_dir=pckl_dir,
+    @classmethod
+    def upsert_save(
+        cls,
+        all_dfs,
+        vocablist,
+        pckl_dir,
+        age_start,
+        age_range,
+        start_is_date,
+        age_in_months,
+        verbose=False,
+        columnar=False,
+        pt_index=None,
+        n_workers=None,
+        stamp=None,
+        max_segments=8,
+        hashes=None,
+    ):
+        """Update the `PatientList` saved in `pckl_dir` with the patients in `all_dfs` - only new patients and those whose cleaned data
+        changed (see `patient_hashes`) are transformed and saved as a new segment, patients no longer there get tombstones.
+        Just their records are numericalized, so a segment costs in proportion to the patients in it.
+        The whole list is created if there is none yet or it was saved with a different `stamp` (e.g. vocab & format).
+        `PatientList.load` merges the segments, which are compacted (see `compact_ptlist`) once there are `max_segments`.
+        Pass the `patient_hashes` of `all_dfs` as `hashes` to reuse them across calls (e.g. for many age windows)"""
+        if pt_index is None:
+            pt_index = PatientIndex.create(all_dfs[0]["patient"].values, all_dfs[2:])
+            all_dfs = all_dfs[:2] + pt_index.sort_tables(all_dfs[2:])
+        ptids = all_dfs[0]["patient"].values
+        if hashes is None:
+            hashes = patient_hashes(all_dfs, pt_index)
+        create_args = [vocablist]
+        create_kwargs = dict(
             age_start=age_start,
             age_range=age_range,
             start_is_date=start_is_date,
             age_in_months=age_in_months,
             verbose=verbose,
+            columnar=columnar,
+            pt_index=pt_index,
+            n_workers=n_workers,
         )
-        all_chunks = pool.map(parallelize, indx_chnks)
-        pool.close()
 
-        print(
-            f"{sum(all_chunks)} total patients completed, saved patient list to {pckl_dir}"
-        )
+        manifest, old_ptids, old_hashes = ptlist_manifest(pckl_dir)
+        if manifest is None or manifest["stamp"] != stamp:
+            delete_ptlist_files(pckl_dir)
+            cls.create_save(all_dfs, *create_args, pckl_dir, **create_kwargs)
+            save_ptlist_manifest(pckl_dir, {"stamp": stamp, "segments": []}, ptids, hashes)
+            return
+
+        old_pos = pd.Index(old_ptids).get_indexer(ptids)
+        known = old_pos >= 0
+        changed = ~known
+        changed[known] = old_hashes[old_pos[known]] != hashes[known]
+        removed = old_ptids[~pd.Index(old_ptids).isin(ptids)]
+        if not changed.any() and len(removed) == 0:
+            print(f"No new, changed or removed patients, patient list in {pckl_dir} is up to date")
+            return
+
+        seg_name = f"segment_{len(manifest['segments']) + 1:04d}"
+        seg_dir = Path(pckl_dir) / "segments" / seg_name
+        if changed.any():
+            changed_index, changed_recs = pt_index.take(ptids[changed], all_dfs[2:])
+            changed_dfs = [all_dfs[0][changed], all_dfs[1]] + changed_recs
+            cls.create_save(changed_dfs, *create_args, seg_dir, **{**create_kwargs, "pt_index": changed_index})
+        else:
+            seg_dir.mkdir(parents=True, exist_ok=True)
+        manifest["segments"].append({"name": seg_name, "tombstones": removed.tolist()})
+        save_ptlist_manifest(pckl_dir, manifest, ptids, hashes)
+        print(f"{changed.sum()} new or changed & {len(removed)} removed patients saved as {seg_name} of {pckl_dir}")
+
+        if max_segments is not None and len(manifest["segments"]) >= max_segments:
+            compact_ptlist(pckl_dir)
 
     @classmethod
     def load(cls, path, split, modality_type, age_start, age_range, start_is_date, age_in_months):
-        """Load previously created `PatientList` object"""
+        """Load previously created `PatientList` object - from either the columnar or the pickled format, merging any upsert segments"""
         pckl_dir = get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months)
         if not pckl_dir.exists():
             raise Exception(
                 f'"{pckl_dir}" does not exist, run pre-processing to create that dataset first.'
             )
-        ptlist = []
-        for file in Path(pckl_dir).glob("*.ptlist"):
-            with open(file, "rb") as infile:
-                ptlist.extend(pickle.load(infile))
+        manifest, _, _ = ptlist_manifest(pckl_dir)
+        if manifest is not None and len(manifest["segments"]) > 0:
+            ptlist = SegmentedPatients(pckl_dir)
+        else:
+            ptlist = load_ptlist_items(pckl_dir)
 
         return cls(
             ptlist, path, split, age_start, age_range, start_is_date, age_in_months
         )
 
 
+# Cell
+def delete_ptlist_files(pckl_dir, segments=True):
+    """Delete `PatientList` files - in either format - previously saved in `pckl_dir`, with its upsert segments & manifest if `segments`"""
+    patterns = ["*.ptlist", "*.npy", ColumnarPatients.meta_fname]
+    if segments:
+        patterns += [MANIFEST_FNAME, PT_HASHES_FNAME]
+        shutil.rmtree(Path(pckl_dir) / "segments", ignore_errors=True)
+    for pattern in patterns:
+        for file in Path(pckl_dir).glob(pattern):
+            file.unlink()
+
+
+def compact_ptlist(pckl_dir):
+    """Fold the upsert segments of the `PatientList` saved in `pckl_dir` back into a single list, in the same patient order"""
+    manifest, ptids, hashes = ptlist_manifest(pckl_dir)
+    if manifest is None or len(manifest["segments"]) == 0:
+        return
+    pts = SegmentedPatients(pckl_dir)
+    compact_dir = Path(pckl_dir) / "compacting"
+    shutil.rmtree(compact_dir, ignore_errors=True)
+    compact_dir.mkdir()
+
+    if isinstance(pts.parts[0], ColumnarPatients):
+        # one chunk per run of consecutive patients from the same part
+        run_starts = np.flatnonzero(np.diff(pts.locs[:, 0], prepend=-1))
+        runs = np.split(pts.locs, run_starts[1:])
+        chunks = [pts.parts[run[0, 0]].chunk(run[:, 1]) for run in runs if len(run) > 0]
+        ColumnarPatients.save(chunks, compact_dir, pts.parts[0].label_names)
+    else:
+        with open(compact_dir / "patients_compacted.ptlist", "wb") as pckl_f:
+            pickle.dump(list(pts), pckl_f)
+
+    delete_ptlist_files(pckl_dir, segments=False)
+    for file in sorted(compact_dir.iterdir(), key=lambda f: f.name == ColumnarPatients.meta_fname):  # meta last
+        file.rename(Path(pckl_dir) / file.name)
+    compact_dir.rmdir()
+    shutil.rmtree(Path(pckl_dir) / "segments")
+    manifest["segments"] = []
+    save_ptlist_manifest(pckl_dir, manifest, ptids, hashes)
+    print(f"Compacted {len(pts)} patients of {pckl_dir}")
+
+
 # Cell
 def create_all_ptlists(
     path: Path,
-    age_start: Any,
-    age_range: int,
-    start_is_date: bool,
-    age_in_months: bool,
+    age_start: Any = None,
+    age_range: int = None,
+    start_is_date: bool = False,
+    age_in_months: bool = False,
     vocab_path: Path = None,
     modalities_file_path: str = None,
     verbose: bool = False,
     delete_existing: bool = True,
+    columnar: bool = False,
+    n_workers: int = None,
+    incremental: bool = False,
+    max_segments: int = 8,
+    windows: list = None,
 ):
-    """Create and save `PatientList`s for train, valid and test given dataset path"""
+    """Create and save `PatientList`s for train, valid and test given dataset path.
+    If `incremental`, existing lists are updated with just the new, changed & removed patients (see `PatientList.upsert_save`).
+    Pass `windows`, a list of `(age_start, age_range, age_in_months)`, to create the lists for all of them (instead of the one window
+    in the arguments) from a single load of the data & pass over the patients (see `PatientList.create_save_windows`)"""
 
     if vocab_path is None:
         vocab_path = path
-    all_dfs_splits = load_cleaned_ehrdata(path)  # train_dfs, valid_dfs, test_dfs
+    if windows is None:
+        if age_start is None or age_range is None:
+            raise ValueError("Pass `age_start` and `age_range`, or a list of `windows`")
+        windows = [(age_start, age_range, age_in_months)]
+    all_dfs_splits = load_cleaned_ehrdata(path, rec_columns=["code", "age", "age_months"])  # train_dfs, valid_dfs, test_dfs
     splits = ["train", "valid", "test"]
     vocablist = EhrVocabList.load(vocab_path)
+    vocab_stat = Path(f"{vocab_path}/processed/vocabs.vocablist").stat()
+    stamp = {"vocab": [vocab_stat.st_size, vocab_stat.st_mtime_ns], "start_is_date": start_is_date, "columnar": columnar}
     if modalities_file_path is not None:
         modalities = pd.read_csv(f"{modalities_file_path}/modalities.csv")
         ptids_by_modality = modalities.groupby(["type"])["id"]
 
-    for all_dfs, split in zip(all_dfs_splits, splits):
-        if modalities_file_path is not None:
-            # Do for each modality_type
-            for mod_type, ptids in ptids_by_modality:
-                pts = all_dfs[0]
-                filtered_pts = pts[pts["patient"].isin(ptids)]
-                if len(filtered_pts) == 0:
-                    continue
-                mod_type_all_dfs = [filtered_pts]
-                mod_type_all_dfs.extend(all_dfs[1:])
-
-                pckl_dir = get_pckl_dir(
-                    path, split, mod_type, age_start, age_range, age_in_months
+    def save_ptlists(ptlist_dfs, split, mod_type, pt_index, shared_recs):
+        pckl_dirs = [get_pckl_dir(path, split, mod_type, *window) for window in windows]
+        if incremental:
+            hashes = patient_hashes(ptlist_dfs, pt_index)  # once for all windows
+            for pckl_dir, (age_start, age_range, age_in_months) in zip(pckl_dirs, windows):
+                PatientList.upsert_save(
+                    ptlist_dfs, vocablist, pckl_dir, age_start, age_range, start_is_date, age_in_months, verbose, columnar,
+                    pt_index, n_workers, stamp=stamp, max_segments=max_segments, hashes=hashes,
                 )
-                if delete_existing:
-                    for file in Path(pckl_dir).glob("*.ptlist"):
-                        file.unlink()
-                PatientList.create_save(
-                    mod_type_all_dfs,
-                    vocablist,
-                    pckl_dir,
-                    age_start,
-                    age_range,
-                    start_is_date,
-                    age_in_months,
-                    verbose,
-                )
-        else:
-            # do once with moality_type = 0 (for EHR only)
-            pckl_dir = get_pckl_dir(path, split, 0, age_start, age_range, age_in_months)
-            if delete_existing:
-                for file in Path(pckl_dir).glob("*.ptlist"):
-                    file.unlink()
-            PatientList.create_save(
-                all_dfs,
-                vocablist,
-                pckl_dir,
-                age_start,
-                age_range,
-                start_is_date,
-                age_in_months,
-                verbose,
-            )
+            return
+        if delete_existing:
+            for pckl_dir in pckl_dirs:
+                delete_ptlist_files(pckl_dir)
+        PatientList.create_save_windows(
+            ptlist_dfs, vocablist, [(pckl_dir, *window) for pckl_dir, window in zip(pckl_dirs, windows)], start_is_date,
+            verbose, columnar, pt_index, n_workers, shared_recs=shared_recs,
+        )
+
+    for all_dfs, split in zip(all_dfs_splits, splits):
+        pt_index = PatientIndex.for_split(path, split, all_dfs)
+        all_dfs = all_dfs[:2] + pt_index.sort_tables(all_dfs[2:])
+        with contextlib.nullcontext() if incremental else tempfile.TemporaryDirectory() as shared_dir:
+            # records are numericalized once per split, for all windows & modalities
+            shared_recs = None if incremental else SharedRecords.save(all_dfs[2:], vocablist.records_vocabs, shared_dir)
+            if modalities_file_path is not None:
+                # Do for each modality_type
+                for mod_type, ptids in ptids_by_modality:
+                    pts = all_dfs[0]
+                    filtered_pts = pts[pts["patient"].isin(ptids)]
+                    if len(filtered_pts) == 0:
+                        continue
+                    mod_type_all_dfs = [filtered_pts]
+                    mod_type_all_dfs.extend(all_dfs[1:])
+                    save_ptlists(mod_type_all_dfs, split, mod_type, pt_index, shared_recs)
+            else:
+                # do once with moality_type = 0 (for EHR only)
+                save_ptlists(all_dfs, split, 0, pt_index, shared_recs)
 
 
 # Cell
@@ -463,13 +1209,29 @@ def preprocess_ehr_dataset(
     vocab_path=None,
     modalities_file_path=None,
     from_raw_data=False,
+    columnar=False,
+    split_chunksize=None,
+    split_by_hash=False,
+    incremental_ptlists=False,
+    windows=None,
+    incremental_cleaning=False,
+    executor=None,
 ):
-    """Do all preprocessing - split, clean raw data; create vocab lists; create patient lists"""
+    """Do all preprocessing - split, clean raw data; create vocab lists; create patient lists.
+    Pass `windows` (a list of `(age_start, age_range, age_in_months)`) to create patient lists for all of them.
+    If `incremental_cleaning`, only changed tables are re-cleaned (on `executor`, see `clean_raw_ehrdata`) and the vocab lists
+    are only re-created if any were - so re-create them yourself to change `obs_vocab_buckets` on unchanged data"""
     if from_raw_data:
         print("------------ Splitting and cleaning raw dataset ------------")
-        clean_raw_ehrdata(path, valid_pct, test_pct, conditions_dict, today)
-        print("------------ Creating vocab lists ------------")
-        EhrVocabList.create(path, num_buckets=obs_vocab_buckets).save()
+        peaks = clean_raw_ehrdata(
+            path, valid_pct, test_pct, conditions_dict, today, chunksize=split_chunksize, split_by_hash=split_by_hash,
+            executor=executor, incremental=incremental_cleaning,
+        )
+        if len(peaks) == 0 and Path(f"{path}/processed/vocabs.vocablist").exists():
+            print("Cleaned data unchanged; skipping Vocab-creation")
+        else:
+            print("------------ Creating vocab lists ------------")
+            EhrVocabList.create(path, num_buckets=obs_vocab_buckets).save()
     else:
         print("Data is pre-cleaned; skipping Cleaning, Splitting & Vocab-creation")
 
@@ -482,4 +1244,7 @@ def preprocess_ehr_dataset(
         age_in_months=age_in_months,
         vocab_path=vocab_path,
         modalities_file_path=modalities_file_path,
-    )
+        columnar=columnar,
+        incremental=incremental_ptlists,
+        windows=windows,
+    )
\ No newline at end of file
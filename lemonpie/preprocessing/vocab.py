@@ -1,6 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_preprocessing_vocab.ipynb (unless otherwise specified).
 
-__all__ = ['multiple_of_8', 'EhrVocab', 'ObsVocab', 'EhrVocabList', 'get_all_emb_dims']
+__all__ = ['multiple_of_8', 'EhrVocab', 'nested_uniques', 'linspace_rows', 'ObsVocab', 'EhrVocabList',
+           'get_all_emb_dims']
 
 # Cell
 from ..basics import *
@@ -23,11 +24,36 @@ def multiple_of_8(orig):
 # Cell
 class EhrVocab():
     '''Vocab class for most EHR datatypes'''
+    _index_attrs = ['_code_idx', '_code_nums']
+
     def __init__(self, itoc, ctoi, ctod=None):
         self.itoc = itoc
         self.ctoi = ctoi
         if ctod is not None: self.ctod = ctod
         self.vocab_size = len(self.itoc)
+        self._build_indexes()
+
+    def __getstate__(self):
+        '''Pickle without the lookup indexes (same format as before), they are rebuilt on load'''
+        return {k: v for k, v in self.__dict__.items() if k not in self._index_attrs}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_indexes()
+
+    def _build_indexes(self):
+        '''Build a `pd.Index` of codes (and their indices) for vectorized lookups'''
+        self._code_idx  = pd.Index(list(self.ctoi.keys()))
+        self._code_nums = np.array(list(self.ctoi.values()), dtype=np.int64)
+
+    def _log_unknowns(self, codes, log_dir='default_log_store', msg='code'):
+        '''Append all unknown codes of a numericalize call to the exceptions log in one write'''
+        if len(codes) == 0: return
+        today = date.today().strftime("%Y-%m-%d")
+        log_dir = LOG_STORE if log_dir=='default_log_store' else log_dir
+        if not os.path.isdir(log_dir): os.mkdir(log_dir)
+        with open(f'{log_dir}/{today}_numericalize_exceptions.log', 'a') as log:
+            log.write(''.join(f'\n{msg}: {code}' for code in codes))
 
     @classmethod
     def create(cls, codes_df):
@@ -45,12 +71,11 @@ class EhrVocab():
         ctoi = {code: i for i, code in enumerate(itoc)}
 
         if desc_exists:
-            codes_df.set_index('code', inplace=True)
+            descs = codes_df.groupby('code', sort=False)['desc'].unique() # in the same order as `itoc`
             ctod = {}
             ctod[itoc[0]] = "Nothing recorded"
             ctod[itoc[1]] = "Unknown"
-            for code in itoc[2:orig_len]:
-                ctod[code] = set(codes_df.loc[code].desc)
+            ctod.update(zip(descs.index, map(set, descs.values)))
             for code in itoc[orig_len:]:
                 ctod[code] = "Padding for AMP"
 
@@ -65,26 +90,15 @@ class EhrVocab():
 
     def numericalize(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
         '''Lookup and return indices for codes'''
-
-        if log_excep:
-            today = date.today().strftime("%Y-%m-%d")
-            log_dir = LOG_STORE if log_dir=='default_log_store' else log_dir
-            if not os.path.isdir(log_dir): os.mkdir(log_dir)
-            logfile = f'{log_dir}/{today}_numericalize_exceptions.log'
-
-        res = []
-        try:
-            res = [self.ctoi[str(code)] for code in codes] #no big performance benefit
-        except KeyError:
-            for code in codes:
-                try:
-                    res.append(self.ctoi[str(code)])
-                except KeyError:
-                    res.append(self.ctoi['xxunk'])
-                    if log_excep:
-                        with open(logfile, 'a') as log:
-                            log.write(f'\ncode: {code}')
-
+        return self.numericalize_array(codes, log_excep, log_dir).tolist()
+
+    def numericalize_array(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
+        '''Lookup and return indices (`np.int64` array) for an array of codes in one vectorized call, unknown codes get `xxunk`'''
+        codes = pd.Index(np.asarray(codes, dtype=object), dtype=object).astype(str)
+        pos = self._code_idx.get_indexer(codes)
+        unknown = pos == -1
+        res = np.where(unknown, self.ctoi['xxunk'], self._code_nums[pos])
+        if log_excep: self._log_unknowns(codes[unknown], log_dir)
         return res
 
     def textify(self, indxs):
@@ -95,43 +109,92 @@ class EhrVocab():
             res = [ (self.itoc[i]) for i in indxs ]
         return res
 
+# Cell
+def nested_uniques(df, keys):
+    '''First row of each unique combination of `keys`, in the order nested loops over `unique()` values would visit
+    them - by first appearance of `keys[0]`, then of `keys[1]` within it, and so on'''
+    uniqs = df.drop_duplicates(keys)
+    ranks = [uniqs.groupby(keys[:i], sort=False).ngroup().values for i in range(1, len(keys))]
+    return uniqs.iloc[np.lexsort(ranks[::-1])] if len(ranks) > 0 else uniqs
+
+def linspace_rows(starts, stops, num):
+    '''`np.linspace(start, stop, num)` for each pair of `starts` & `stops` - one row each, same values as the scalar calls'''
+    starts, stops = np.asarray(starts, dtype=float), np.asarray(stops, dtype=float)
+    res = np.repeat(starts[:, None], num, axis=1)
+    ranged = starts != stops # `np.linspace` computes all rows differently if any row has a zero range
+    if ranged.any(): res[ranged] = np.linspace(starts[ranged], stops[ranged], num=num, axis=1)
+    return res
+
 # Cell
 class ObsVocab (EhrVocab):
     '''Special Vocab class for Observation codes'''
+    _index_attrs = ['_special_idxs', '_text_idxs', '_numeric_idxs']
+
     def __init__(self, vocab_df):
         self.vocab_df = vocab_df
         self.vocab_size = len(vocab_df)
+        self._build_indexes()
+
+    def _build_indexes(self):
+        '''Build lookup indexes - a hash map for text codes and sorted bucket values for each numeric (code, units)'''
+        vocab_df = self.vocab_df
+        self._special_idxs = {code: vocab_df[vocab_df['code'] == code].index.tolist() for code in ['xxnone','xxunk']}
+
+        self._text_idxs = {}
+        texts = vocab_df[vocab_df['type'] != 'numeric']
+        for indx, key in zip(texts.index, zip(texts.code, texts.value, texts.units, texts.type)):
+            self._text_idxs.setdefault(key, []).append(indx)
+
+        self._numeric_idxs = {}
+        numerics = vocab_df[vocab_df['type'] == 'numeric'].astype({'value':'float'})
+        for key, this_unit in numerics.groupby(['code','units'], sort=False):
+            order = np.argsort(this_unit.value.values, kind='stable')
+            self._numeric_idxs[key] = this_unit.value.values[order], this_unit.index.values[order]
+
+    def _closest_numeric(self, c, v, u):
+        '''Index of the bucket closest to value `v` for code `c` in units `u` (ties go to the lower index, like `argsort`)'''
+        if (c,u) not in self._numeric_idxs: return []
+        vals, indxs = self._numeric_idxs[(c,u)]
+        pos = np.searchsorted(vals, v)
+        candidates = []
+        if pos > 0:
+            lo = np.searchsorted(vals, vals[pos-1]) # first of any duplicate bucket values
+            candidates.append((v - vals[lo], indxs[lo]))
+        if pos < len(vals): candidates.append((vals[pos] - v, indxs[pos]))
+        return [int(min(candidates)[1])]
+
+    def _lookup(self, code):
+        '''Indices for a single observation code (empty if not in vocab)'''
+        if code in self._special_idxs: return self._special_idxs[code]
+        c,v,u,t = code.split('||')
+        if t == 'numeric': return self._closest_numeric(c, float(v), u)
+        else             : return self._text_idxs.get((c,v,u,t), [])
 
     def numericalize(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
         '''Numericalize observation codes (return indices for codes)'''
-
-        if log_excep:
-            today = date.today().strftime("%Y-%m-%d")
-            log_dir = LOG_STORE if log_dir=='default_log_store' else log_dir
-            if not os.path.isdir(log_dir): os.mkdir(log_dir)
-            logfile = f'{log_dir}/{today}_numericalize_exceptions.log'
-
-        indxs = []
+        indxs, unknowns = [], []
         for code in codes:
-            if code in ['xxnone','xxunk']: indxs.extend(self.vocab_df[(self.vocab_df['code'] == code)].index.tolist())
-            else:
-                c,v,u,t = code.split('||')
-                if t == 'numeric':
-                    filt_df = self.vocab_df[(self.vocab_df['code'] == c) & (self.vocab_df['units'] == u) & (self.vocab_df['type'] == t)]
-                    res = filt_df.iloc[(filt_df.value - float(v)).abs().argsort()[:1]].index.tolist()
-                else:
-                    res = self.vocab_df[(self.vocab_df['code'] == c) & (self.vocab_df['value'] == v) & \
-                                               (self.vocab_df['units'] == u) & (self.vocab_df['type'] == t)].index.tolist()
-                if len(res) == 0:
-                    indxs.extend(self.vocab_df[(self.vocab_df['code'] == 'xxunk')].index.tolist())
-                    if log_excep:
-                        with open(logfile, 'a') as log:
-                            log.write(f'\ncode in ObsVocab: {code}')
-                else            : indxs.extend(res)
+            res = self._lookup(code)
+            if len(res) == 0:
+                indxs.extend(self._special_idxs['xxunk'])
+                unknowns.append(code)
+            else: indxs.extend(res)
 
+        if log_excep: self._log_unknowns(unknowns, log_dir, msg='code in ObsVocab')
         assert len(codes) == len(indxs), "Possible bug, not all codes being numericalized"
         return indxs
 
+    def numericalize_array(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
+        '''Numericalize an array of observation codes (returns `np.int64` array) - each unique code is looked up only once'''
+        codes = np.asarray(codes, dtype=object)
+        inv, uniqs = pd.factorize(codes)
+        uniq_indxs = self.numericalize(uniqs, log_excep=False)
+        res = np.array(uniq_indxs, dtype=np.int64)[inv]
+        if log_excep:
+            unknown = (res == self._special_idxs['xxunk'][0]) & (codes != 'xxunk')
+            self._log_unknowns(codes[unknown], log_dir, msg='code in ObsVocab')
+        return res
+
     def textify(self, indxs):
         '''Textify observation codes (returns codes and descriptions)'''
         txts = []
@@ -148,21 +211,22 @@ class ObsVocab (EhrVocab):
         numerics = pd.DataFrame(obs_codes.loc[obs_codes['type'] == 'numeric',:])
         texts = pd.DataFrame(obs_codes.loc[obs_codes['type'] == 'text',:])
         numerics = numerics.astype({'value':'float'}, copy=False)
-        vocab_rows = []
-
-        for code in numerics.orig_code.unique():
-            this_code = numerics.loc[numerics['orig_code'] == code]
-            for unit in this_code.units.unique():
-                this_unit = this_code.loc[this_code['units'] == unit]
-                for val in np.linspace(this_unit.value.min(), this_unit.value.max(), num=num_buckets):
-                    vocab_rows.append([code,this_unit.desc.iloc[0],val,unit,'numeric'])
-
-        for code in texts.orig_code.unique():
-            this_code = texts.loc[texts['orig_code'] == code]
-            for unit in this_code.units.unique():
-                this_unit = this_code.loc[this_code['units'] == unit]
-                for val in this_unit.value.unique():
-                    vocab_rows.append([code,this_unit.desc.iloc[0],val,unit,'text'])
+
+        # numeric - `num_buckets` evenly spaced values from min to max of each (code, units)
+        num_units = nested_uniques(numerics, ['orig_code', 'units'])
+        val_ranges = numerics.groupby(['orig_code', 'units'], sort=False)['value'].agg(['min', 'max'])
+        val_ranges = val_ranges.reindex(pd.MultiIndex.from_frame(num_units[['orig_code', 'units']]))
+        num_vals = linspace_rows(val_ranges['min'].values, val_ranges['max'].values, num_buckets).ravel()
+        num_rows = zip(np.repeat(num_units.orig_code.values, num_buckets), np.repeat(num_units.desc.values, num_buckets),
+                       num_vals, np.repeat(num_units.units.values, num_buckets), ['numeric']*len(num_vals))
+
+        # text - each unique value of each (code, units), with the description of the (code, units)' first row
+        text_vals = nested_uniques(texts, ['orig_code', 'units', 'value'])
+        text_descs = nested_uniques(texts, ['orig_code', 'units']).set_index(['orig_code', 'units']).desc
+        text_descs = text_descs.reindex(pd.MultiIndex.from_frame(text_vals[['orig_code', 'units']])).values
+        text_rows = zip(text_vals.orig_code.values, text_descs, text_vals.value.values, text_vals.units.values, ['text']*len(text_vals))
+
+        vocab_rows = [list(row) for row in num_rows] + [list(row) for row in text_rows]
 
         vocab_rows.insert(0, ['xxnone','Nothing recorded','xxnone','xxnone','xxnone'])
         vocab_rows.insert(1, ['xxunk','Unknown','xxunk','xxunk','xxunk'])